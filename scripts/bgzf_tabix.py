@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+"""Concatenate BGZF files, and pass BGZF blocks through into a new VCF with its tabix (TBI) index remapped."""
+
+import gzip
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Max. uncompressed bytes per BGZF block, as used by htslib
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_APPEND_CHUNK_SIZE = 16 * 1024 * 1024
+BGZF_EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+TBI_MAGIC = b'TBI\x01'
+TBI_VCF_PRESET = 2
+TBI_MIN_SHIFT = 14
+TBI_PSEUDO_BIN = 37450
+SVLEN_SYMBOLIC_ALLELE_PREFIXES = ('<DEL', '<DUP', '<INV', '<CNV')
+
+
+def compress_bgzf_block(data, level=zlib.Z_DEFAULT_COMPRESSION):
+    """Compress a chunk of at most BGZF_BLOCK_SIZE bytes into a BGZF block."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+
+    # gzip header with the 'BC' extra subfield holding the total block size - 1
+    header = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25)
+    trailer = struct.pack('<2I', zlib.crc32(data), len(data))
+
+    return header + cdata + trailer
+
+
+def read_bgzf_block(fh, offset):
+    """Read the BGZF block at a file offset, returning its uncompressed data and the offset of the next block."""
+    fh.seek(offset)
+    header = fh.read(18)
+    if len(header) < 18:
+        raise ValueError(f'Truncated BGZF block at {offset}.')
+    id1, id2, _, flags, _, _, _, _, si1, si2, _, block_size = struct.unpack('<4BI2BH2BHH', header)
+    if (id1, id2, flags, si1, si2) != (31, 139, 4, 66, 67):
+        raise ValueError(f'Invalid BGZF block at {offset}.')
+
+    rest = fh.read(block_size + 1 - 18)
+    data = zlib.decompress(rest[:-8], -15)
+
+    return data, offset + block_size + 1
+
+
+def get_bgzf_data_size(fh):
+    """Get the size of a BGZF file without its EOF marker block."""
+    size = fh.seek(0, 2)
+    if size >= len(BGZF_EOF_BLOCK):
+        fh.seek(size - len(BGZF_EOF_BLOCK))
+        if fh.read() == BGZF_EOF_BLOCK:
+            size -= len(BGZF_EOF_BLOCK)
+
+    return size
+
+
+def copy_bgzf_blocks(src_fh, dst_fh, start, end):
+    """Copy the whole BGZF blocks in a byte range of one file to another."""
+    # Parts can be large, so they are copied in chunks rather than read whole
+    src_fh.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        data = src_fh.read(min(remaining, BGZF_APPEND_CHUNK_SIZE))
+        if not data:
+            raise ValueError('Truncated BGZF file.')
+        dst_fh.write(data)
+        remaining -= len(data)
+
+
+def concat_bgzf_files(path, part_paths):
+    """Concatenate BGZF part files into one file, removing the parts and keeping only the last EOF marker block."""
+    with open(path, 'wb') as dst_fh:
+        for part_path in part_paths:
+            with open(part_path, 'rb') as fh:
+                copy_bgzf_blocks(fh, dst_fh, 0, get_bgzf_data_size(fh))
+            os.remove(part_path)
+        dst_fh.write(BGZF_EOF_BLOCK)
+
+
+def reg2bin(beg, end):
+    """Get the UCSC/tabix bin of a 0-based, half-open interval."""
+    end -= 1
+    if beg >> 14 == end >> 14:
+        return ((1 << 15) - 1) // 7 + (beg >> 14)
+    if beg >> 17 == end >> 17:
+        return ((1 << 12) - 1) // 7 + (beg >> 17)
+    if beg >> 20 == end >> 20:
+        return ((1 << 9) - 1) // 7 + (beg >> 20)
+    if beg >> 23 == end >> 23:
+        return ((1 << 6) - 1) // 7 + (beg >> 23)
+    if beg >> 26 == end >> 26:
+        return ((1 << 3) - 1) // 7 + (beg >> 26)
+    return 0
+
+
+def get_vcf_line_interval(line):
+    """Get the 0-based, half-open interval tabix assigns to a VCF data line."""
+    cols = line.split('\t', 8)
+    beg = int(cols[1]) - 1
+    end = beg + max(len(cols[3]), 1)
+    if len(cols) < 8:
+        return cols[0], beg, end
+
+    # As in htslib's tbx_parse1(), INFO/END and the SVLEN of symbolic deletions, duplications, inversions and CNVs
+    # can extend the interval past REF
+    for info_field in cols[7].split(';'):
+        if info_field.startswith('END='):
+            info_end = parse_int(info_field[4:])
+            if info_end is not None and info_end > beg:
+                end = max(end, info_end)
+        elif info_field.startswith('SVLEN='):
+            for alt, sv_len in zip(cols[4].split(','), info_field[6:].split(',')):
+                sv_len = parse_int(sv_len)
+                if sv_len is not None and alt.startswith(SVLEN_SYMBOLIC_ALLELE_PREFIXES):
+                    end = max(end, beg + abs(sv_len))
+
+    return cols[0], beg, end
+
+
+def parse_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+class BgzfWriter:
+    """BGZF file writer handing out virtual offsets, with blocks optionally compressed by a thread pool."""
+
+    def __init__(self, path, threads=1, level=zlib.Z_DEFAULT_COMPRESSION):
+        self.fh = open(path, 'wb')
+        self.level = level
+        self.buffer = bytearray()
+        self.block_count = 0
+        self.block_offsets = [0]
+        self.executor = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        self.pending_blocks = []
+        self.max_pending_block_count = threads * 4
+
+    def tell(self):
+        """Get the position of the next byte, encoded like a virtual offset but with a block no. in place of its file offset."""
+        return (self.block_count << 16) | len(self.buffer)
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= BGZF_BLOCK_SIZE:
+            self.flush_block(bytes(self.buffer[:BGZF_BLOCK_SIZE]))
+            del self.buffer[:BGZF_BLOCK_SIZE]
+
+    def append_bgzf_blocks(self, fh, start, end):
+        """Append the whole BGZF blocks in a byte range of another file, returning the file offset they start at."""
+        self.flush()
+        self.drain_blocks()
+        copy_bgzf_blocks(fh, self.fh, start, end)
+
+        # The appended blocks count as one block for tell()
+        offset = self.block_offsets[-1]
+        self.block_count += 1
+        self.block_offsets.append(offset + end - start)
+
+        return offset
+
+    def flush(self):
+        """End the current block, so the next write starts a new one."""
+        if len(self.buffer) > 0:
+            self.flush_block(bytes(self.buffer))
+            self.buffer = bytearray()
+
+    def flush_block(self, data):
+        self.block_count += 1
+        if self.executor is None:
+            self.write_block(compress_bgzf_block(data, self.level))
+            return
+
+        self.pending_blocks.append(self.executor.submit(compress_bgzf_block, data, self.level))
+        if len(self.pending_blocks) >= self.max_pending_block_count:
+            self.write_block(self.pending_blocks.pop(0).result())
+
+    def drain_blocks(self):
+        while len(self.pending_blocks) > 0:
+            self.write_block(self.pending_blocks.pop(0).result())
+
+    def write_block(self, block):
+        self.fh.write(block)
+        self.block_offsets.append(self.block_offsets[-1] + len(block))
+
+    def get_virtual_offset(self, position):
+        """Resolve a tell() position once its block has been written."""
+        return (self.block_offsets[position >> 16] << 16) | (position & 0xffff)
+
+    def close(self):
+        self.flush()
+        self.drain_blocks()
+
+        self.fh.write(BGZF_EOF_BLOCK)
+        self.fh.close()
+
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+class TabixIndexBuilder:
+    """Builds a VCF tabix index from records as they are written, given their BgzfWriter positions."""
+
+    def __init__(self):
+        self.contig_names = []
+        self.contig_indices = {}
+
+    def add(self, contig, beg, end, start_position, end_position):
+        if contig not in self.contig_indices:
+            self.contig_indices[contig] = {'bins': {}, 'linear': {}, 'last_bin': None, 'last_beg': -1,
+                                           'first_position': start_position, 'record_count': 0}
+            self.contig_names.append(contig)
+        elif self.contig_names[-1] != contig:
+            raise ValueError(f'Contig \'{contig}\' is not contiguous in the file.')
+
+        contig_index = self.contig_indices[contig]
+        if beg < contig_index['last_beg']:
+            raise ValueError(f'Records on \'{contig}\' are not sorted by position.')
+        contig_index['last_beg'] = beg
+        contig_index['last_position'] = end_position
+        contig_index['record_count'] += 1
+
+        # Consecutive records in the same bin share a chunk
+        bin_no = reg2bin(beg, end)
+        bin_chunks = contig_index['bins'].setdefault(bin_no, [])
+        if bin_no == contig_index['last_bin'] and bin_chunks[-1][1] == start_position:
+            bin_chunks[-1][1] = end_position
+        else:
+            bin_chunks.append([start_position, end_position])
+        contig_index['last_bin'] = bin_no
+
+        for window in range(beg >> TBI_MIN_SHIFT, ((end - 1) >> TBI_MIN_SHIFT) + 1):
+            contig_index['linear'].setdefault(window, start_position)
+
+    def add_vcf_line(self, line, start_position, end_position):
+        self.add(*get_vcf_line_interval(line), start_position, end_position)
+
+    def get_contig_index(self, contig, resolve_offset):
+        """Get the (bins, linear offsets, pseudo-bin chunks) of a contig, with positions resolved to virtual offsets."""
+        contig_index = self.contig_indices[contig]
+        bins = {b: [[resolve_offset(p) for p in chunk] for chunk in chunks] for b, chunks in contig_index['bins'].items()}
+
+        # Windows without records point at the closest preceding record, or at the contig's first record, as in htslib
+        linear_offsets = []
+        prev_offset = resolve_offset(contig_index['first_position'])
+        for window in range(max(contig_index['linear']) + 1):
+            if window in contig_index['linear']:
+                prev_offset = resolve_offset(contig_index['linear'][window])
+            linear_offsets.append(prev_offset)
+
+        pseudo_bin_chunks = [[resolve_offset(contig_index['first_position']), resolve_offset(contig_index['last_position'])],
+                             [contig_index['record_count'], 0]]
+
+        return bins, linear_offsets, pseudo_bin_chunks
+
+
+def write_tabix_index(path, contig_indices, no_coor_count=0):
+    """Write a VCF tabix index from (contig, bins, linear offsets, pseudo-bin chunks) tuples."""
+    names = b''.join(contig.encode() + b'\0' for contig, _, _, _ in contig_indices)
+    data = bytearray(TBI_MAGIC)
+    data += struct.pack('<8i', len(contig_indices), TBI_VCF_PRESET, 1, 2, 0, ord('#'), 0, len(names))
+    data += names
+
+    for _, bins, linear_offsets, pseudo_bin_chunks in contig_indices:
+        data += struct.pack('<i', len(bins) + 1)
+        for bin_no in sorted(bins):
+            data += struct.pack('<Ii', bin_no, len(bins[bin_no]))
+            for chunk_beg, chunk_end in bins[bin_no]:
+                data += struct.pack('<2Q', chunk_beg, chunk_end)
+        data += struct.pack('<Ii', TBI_PSEUDO_BIN, 2)
+        for chunk_beg, chunk_end in pseudo_bin_chunks:
+            data += struct.pack('<2Q', chunk_beg, chunk_end)
+
+        data += struct.pack('<i', len(linear_offsets))
+        data += struct.pack(f'<{len(linear_offsets)}Q', *linear_offsets)
+
+    data += struct.pack('<Q', no_coor_count)
+
+    writer = BgzfWriter(path)
+    writer.write(bytes(data))
+    writer.close()
+
+
+def read_tabix_index(path):
+    """Read a VCF tabix index into (contig, bins, linear offsets, pseudo-bin chunks) tuples and its no. of unplaced records."""
+    with gzip.open(path, 'rb') as fh:
+        data = fh.read()
+    if data[:4] != TBI_MAGIC:
+        raise ValueError(f'\'{path}\' is not a tabix index.')
+
+    contig_count, preset, _, _, _, _, _, names_length = struct.unpack_from('<8i', data, 4)
+    if preset & 0xffff != TBI_VCF_PRESET:
+        raise ValueError(f'\'{path}\' is not a VCF tabix index.')
+    pos = 36
+    contigs = data[pos:pos + names_length].split(b'\0')[:contig_count]
+    pos += names_length
+
+    contig_indices = []
+    for contig in contigs:
+        bins = {}
+        pseudo_bin_chunks = None
+        bin_count, = struct.unpack_from('<i', data, pos)
+        pos += 4
+        for _ in range(bin_count):
+            bin_no, chunk_count = struct.unpack_from('<Ii', data, pos)
+            pos += 8
+            chunks = [list(struct.unpack_from('<2Q', data, pos + 16 * i)) for i in range(chunk_count)]
+            pos += 16 * chunk_count
+            if bin_no == TBI_PSEUDO_BIN:
+                pseudo_bin_chunks = chunks
+            else:
+                bins[bin_no] = chunks
+
+        linear_count, = struct.unpack_from('<i', data, pos)
+        pos += 4
+        linear_offsets = list(struct.unpack_from(f'<{linear_count}Q', data, pos))
+        pos += 8 * linear_count
+
+        contig_indices.append((contig.decode(), bins, linear_offsets, pseudo_bin_chunks))
+
+    no_coor_count = struct.unpack_from('<Q', data, pos)[0] if len(data) >= pos + 8 else 0
+
+    return contig_indices, no_coor_count
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+"""Build and query cached, memory-mapped per-contig coverage indexes of mosdepth region BEDs."""
+
+import gzip
+import io
+import json
+import os
+import shutil
+
+import numpy as np
+
+DEPTH_BED_INDEX_VERSION = 1
+DEPTH_BED_INDEX_SUFFIX = '.depth_index'
+DEPTH_BED_INDEX_META_FILE_NAME = 'index.json'
+DEPTH_BED_INDEX_ARRAY_FILE_NAMES = {
+    'starts': 'starts.npy', 'ends': 'ends.npy', 'depths': 'depths.npy'}
+DEPTH_BED_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def iter_depth_bed_chunks(path):
+    """Iterate over (contigs, starts, ends, depths) arrays of whole-line chunks of a depth BED."""
+    remainder = b''
+    with gzip.open(path, "rb") as fh:
+        while True:
+            chunk = fh.read(DEPTH_BED_CHUNK_SIZE)
+            is_last_chunk = not chunk
+            chunk = remainder + chunk
+            if not is_last_chunk:
+                split_pos = chunk.rfind(b'\n') + 1
+                chunk, remainder = chunk[:split_pos], chunk[split_pos:]
+            if chunk.strip():
+                contigs = np.array([line.split(b'\t', 1)[0] for line in chunk.splitlines() if line])
+                cols = np.loadtxt(
+                    io.BytesIO(chunk), delimiter='\t', usecols=(1, 2, 3),
+                    ndmin=2)
+                yield contigs, cols[:, 0].astype(np.int64), cols[:, 1].astype(np.int64), cols[:, 2].astype(np.float32)
+            if is_last_chunk:
+                break
+
+
+def build_depth_bed_index(path):
+    """Get the sorted per-contig windows and depths of a depth BED."""
+    contig_chunks = {}
+    for contigs, starts, ends, depths in iter_depth_bed_chunks(path):
+        # Windows of a contig are contiguous in mosdepth output, so split each chunk at contig changes
+        run_starts = np.flatnonzero(np.append(True, contigs[1:] != contigs[:-1]))
+        run_ends = np.append(run_starts[1:], len(contigs))
+        for run_start, run_end in zip(run_starts, run_ends):
+            contig_chunks.setdefault(contigs[run_start].decode(), []).append(
+                (starts[run_start:run_end], ends[run_start:run_end], depths[run_start:run_end]))
+
+    contig_ranges = {}
+    arrays = {k: [] for k in DEPTH_BED_INDEX_ARRAY_FILE_NAMES}
+    offset = 0
+    for contig, chunks in contig_chunks.items():
+        starts = np.concatenate([c[0] for c in chunks])
+        order = np.argsort(starts, kind='stable')
+        arrays['starts'].append(starts[order])
+        arrays['ends'].append(np.concatenate([c[1] for c in chunks])[order])
+        arrays['depths'].append(np.concatenate([c[2] for c in chunks])[order])
+        contig_ranges[contig] = (offset, offset + len(starts))
+        offset += len(starts)
+
+    index = {k: np.concatenate(v + [np.empty(0, dtype=np.float32 if k == 'depths' else np.int64)])
+             for k, v in arrays.items()}
+    index['contigs'] = contig_ranges
+    return index
+
+
+def get_depth_bed_index_path(path):
+    return f'{path}{DEPTH_BED_INDEX_SUFFIX}'
+
+
+def get_depth_bed_index_version_name(bed_stat):
+    return f'v{DEPTH_BED_INDEX_VERSION}-{bed_stat.st_size}-{bed_stat.st_mtime_ns}'
+
+
+def save_depth_bed_index(index, path, index_path):
+    bed_stat = os.stat(path)
+    # Each BED version gets its own subdirectory, written aside and published by a single rename, so samples loading
+    # it concurrently never see a partial or replaced index
+    version_name = get_depth_bed_index_version_name(bed_stat)
+    version_path = os.path.join(index_path, version_name)
+    tmp_version_path = f'{version_path}.{os.getpid()}.tmp'
+    os.makedirs(index_path, exist_ok=True)
+    try:
+        os.makedirs(tmp_version_path, exist_ok=True)
+        for k, file_name in DEPTH_BED_INDEX_ARRAY_FILE_NAMES.items():
+            np.save(os.path.join(tmp_version_path, file_name), index[k])
+        with open(os.path.join(tmp_version_path, DEPTH_BED_INDEX_META_FILE_NAME), 'w') as fh:
+            json.dump({
+                'version': DEPTH_BED_INDEX_VERSION,
+                'bed_size': bed_stat.st_size,
+                'bed_mtime_ns': bed_stat.st_mtime_ns,
+                'contigs': index['contigs']
+            }, fh)
+
+        try:
+            os.rename(tmp_version_path, version_path)
+        except OSError:
+            # Another sample published the same version first
+            if not os.path.isdir(version_path):
+                raise
+    finally:
+        shutil.rmtree(tmp_version_path, ignore_errors=True)
+
+    # Indexes of older BED versions are no longer read; ones still being written are left to their writers
+    for entry in os.scandir(index_path):
+        if entry.name == version_name or entry.name.endswith('.tmp'):
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path, ignore_errors=True)
+        else:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+
+def read_depth_bed_index(path, index_path):
+    """Memory-map a cached index, or None if it is missing or older than the BED."""
+    bed_stat = os.stat(path)
+    version_path = os.path.join(index_path, get_depth_bed_index_version_name(bed_stat))
+    try:
+        with open(os.path.join(version_path, DEPTH_BED_INDEX_META_FILE_NAME)) as fh:
+            meta = json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+    if (meta.get('version') != DEPTH_BED_INDEX_VERSION
+            or meta.get('bed_size') != bed_stat.st_size
+            or meta.get('bed_mtime_ns') != bed_stat.st_mtime_ns):
+        return None
+
+    index = {k: np.load(os.path.join(version_path, file_name), mmap_mode='r')
+             for k, file_name in DEPTH_BED_INDEX_ARRAY_FILE_NAMES.items()}
+    index['contigs'] = {c: tuple(r) for c, r in meta['contigs'].items()}
+    return index
+
+
+def load_depth_bed_index(path, index_path=None):
+    """Get the coverage index of a depth BED, building and caching it on first use."""
+    if index_path is None:
+        index_path = get_depth_bed_index_path(path)
+
+    index = read_depth_bed_index(path, index_path)
+    if index is None:
+        index = build_depth_bed_index(path)
+        # The cache is only an optimisation, so an unwritable directory just means an in-memory index
+        try:
+            save_depth_bed_index(index, path, index_path)
+        except OSError:
+            pass
+        else:
+            index = read_depth_bed_index(path, index_path)
+    return index
+
+
+def lookup_depths(index, contigs, positions):
+    """Get the depths at 1-based positions, NaN where no window covers them."""
+    contigs = np.asarray(contigs)
+    positions = np.asarray(positions, dtype=np.int64) - 1
+    depths = np.full(len(positions), np.nan, dtype=np.float32)
+
+    for contig in np.unique(contigs):
+        if contig not in index['contigs']:
+            continue
+        lo, hi = index['contigs'][contig]
+        is_contig = contigs == contig
+        contig_positions = positions[is_contig]
+
+        i = np.searchsorted(index['starts'][lo:hi], contig_positions, side='right') - 1
+        is_covered = i >= 0
+        i = np.maximum(i, 0) + lo
+        is_covered &= contig_positions < index['ends'][i]
+        depths[np.flatnonzero(is_contig)[is_covered]] = index['depths'][i[is_covered]]
+
+    return depths
@@ -1,11 +1,29 @@
 #!/usr/bin/env python
 
 import argparse
+import bisect
 import logging
 import pathlib
 import pysam
+import re
 import sys
 import gzip
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from bgzf_tabix import (BgzfWriter, TabixIndexBuilder, concat_bgzf_files, get_bgzf_data_size, read_bgzf_block,
+                        read_tabix_index, write_tabix_index)
+
+CONTIG_HEADER_PATTERN = re.compile(r'^##contig=<ID=([^,>]+)')
+REF_CACHE_MAX_CONTIG_COUNT = 2
+REF_N_FIX_NAME = 'Fixed REF N bases'
+NON_REF_AF_FIX_NAME = 'Filled in NON_REF AFs'
+REF_BLOCK_MERGE_FIX_NAME = 'Merged reference blocks'
+NON_REF_ALT_SUFFIX = ',<NON_REF>'
+NON_REF_ALT = '<NON_REF>'
+REF_BLOCK_MIN_FIELDS = ('GQ', 'MIN_DP', 'DP')
 
 def smart_open(fn, mode = "rt"):
     if str(fn).endswith(".gz"):
@@ -21,30 +39,446 @@ def parse_arguments():
     parser.add_argument('-r', '--ref', action='store', dest='ref_fasta', type=pathlib.Path, required=True,
                         help='Reference FASTA file path')
     parser.add_argument('-o', '--output', action='store', dest='output_gvcf', type=pathlib.Path, required=True,
-                        help='Output (unzipped) gVCF file path')
+                        help='Output gVCF file path, written BGZF compressed with a tabix index if it ends with .gz')
+    contig_group = parser.add_mutually_exclusive_group()
+    contig_group.add_argument('-c', '--contigs', action='store', dest='contigs', nargs='+', default=['chrY'],
+                              help='Contigs to fix REF N bases on (default: chrY). NON_REF AFs (-f) are filled in and '
+                                   'reference blocks merged by GQ band (-b) on every contig regardless')
+    contig_group.add_argument('-a', '--all_contigs', action='store_true', dest='is_all_contigs',
+                              help='Fix REF N bases on every contig, e.g. for PAR and decoy contigs in the BED')
+    parser.add_argument('-b', '--gq_bands', action='store', dest='gq_bands', type=parse_gq_bands,
+                        help='Comma separated GQ band lower bounds, e.g. 1,10,20,30,40,50,60, to merge adjacent '
+                             'reference blocks whose GQs fall in the same band on every contig (default: no merging)')
+    parser.add_argument('-f', '--fill_non_ref_af', action='store_true', dest='is_non_ref_af_filled',
+                        help='Append the NON_REF AF that clair3 leaves out after called alleles, as AD[NON_REF] / DP '
+                             'to 4 decimal places, on every contig (default: leave AFs as they are)')
+    parser.add_argument('-p', '--passthrough', action='store_true', dest='is_passthrough',
+                        help='Copy the compressed blocks of contigs not being fixed as they are, '
+                             'if the input is BGZF with a .tbi index and neither -f nor GQ bands are given')
+    parser.add_argument('-t', '--threads', action='store', dest='threads', type=int, default=1,
+                        help='Number of processes fixing contigs in parallel if the input is tabix indexed, '
+                             'or of threads compressing the fixed contigs with --passthrough')
 
     return parser.parse_args()
 
+def parse_gq_bands(value):
+    try:
+        gq_bands = sorted(int(b) for b in value.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid GQ bands: \'{value}\'')
+    return gq_bands
+
+class ReferenceContigCache:
+    """Reference contig sequences, each loaded once into a byte buffer, keeping the most recently used ones."""
+
+    def __init__(self, ref_fasta, max_contig_count=REF_CACHE_MAX_CONTIG_COUNT):
+        self.ref_seq = pysam.FastaFile(str(ref_fasta))
+        self.max_contig_count = max_contig_count
+        self.contig_seqs = OrderedDict()
+
+    def get_base(self, contig, pos):
+        """Get the base at a 1-based position."""
+        seq = self.contig_seqs.get(contig)
+        if seq is None:
+            seq = np.frombuffer(self.ref_seq.fetch(contig).encode(), dtype=np.uint8)
+            self.contig_seqs[contig] = seq
+            if len(self.contig_seqs) > self.max_contig_count:
+                self.contig_seqs.popitem(last=False)
+        else:
+            self.contig_seqs.move_to_end(contig)
+        return chr(seq[pos - 1])
+
+    def close(self):
+        self.contig_seqs.clear()
+        self.ref_seq.close()
+
+class GvcfLineFixer:
+    """Fixes REF N bases of gVCF records on the given contigs, or all, counting the fixes per contig.
+
+    Missing NON_REF AFs are also filled in if asked for, and adjacent reference blocks in the same GQ band merged if
+    GQ bands are given, both on every contig.
+    """
+
+    def __init__(self, ref_contigs, contigs=None, gq_bands=None, is_non_ref_af_filled=False):
+        self.ref_contigs = ref_contigs
+        self.contigs = None if contigs is None else set(contigs)
+        self.gq_bands = gq_bands
+        self.is_non_ref_af_filled = is_non_ref_af_filled
+        self.fix_counts = Counter()
+        self.format_field_indices = {}
+
+    def is_contig_fixed(self, contig):
+        return self.contigs is None or contig in self.contigs
+
+    def is_contig_changed(self, contig):
+        """Check if any record of a contig can be rewritten, so its blocks cannot be passed through."""
+        return self.gq_bands is not None or self.is_non_ref_af_filled or self.is_contig_fixed(contig)
+
+    def get_format_field_indices(self, format_str):
+        """Get the (AD, DP, AF) indices in a FORMAT, or None if any is missing, looking each FORMAT up once."""
+        indices = self.format_field_indices.get(format_str)
+        if indices is None and format_str not in self.format_field_indices:
+            keys = format_str.split(':')
+            if all(k in keys for k in ('AD', 'DP', 'AF')):
+                indices = (keys.index('AD'), keys.index('DP'), keys.index('AF'))
+            self.format_field_indices[format_str] = indices
+        return indices
+
+    def fix_line(self, l):
+        if l.startswith('#'):
+            return l
+        t = l.split('\t', 5)
+        is_ref_n = t[3] == "N" and self.is_contig_fixed(t[0])
+        # Clair3 leaves out the AF of NON_REF when it follows called alleles
+        is_non_ref_af_missing = self.is_non_ref_af_filled and t[4].endswith(NON_REF_ALT_SUFFIX)
+        if not (is_ref_n or is_non_ref_af_missing):
+            return l
+
+        if is_ref_n:
+            base = self.ref_contigs.get_base(t[0], int(t[1]))
+            if base != "N":
+                t[3] = base
+                self.fix_counts[REF_N_FIX_NAME, t[0]] += 1
+
+        if is_non_ref_af_missing:
+            cols = t[5].split('\t')
+            indices = self.get_format_field_indices(cols[3]) if len(cols) > 4 else None
+            if indices is not None:
+                allele_count = t[4].count(',') + 1
+                is_fixed = False
+                for i in range(4, len(cols)):
+                    sample = self.append_non_ref_af(cols[i], indices, allele_count)
+                    if sample is not None:
+                        cols[i] = sample
+                        is_fixed = True
+                if is_fixed:
+                    t[5] = '\t'.join(cols)
+                    self.fix_counts[NON_REF_AF_FIX_NAME, t[0]] += 1
+
+        return '\t'.join(t)
+
+    def fix_lines(self, lines):
+        lines = map(self.fix_line, lines)
+        if self.gq_bands is None:
+            return lines
+        return self.merge_ref_blocks(lines)
+
+    def merge_ref_blocks(self, lines):
+        """Merge runs of adjacent reference blocks whose GQs fall in the same band, like GATK's --gvcf-gq-bands."""
+        block = None
+        for l in lines:
+            next_block = None
+            if not l.startswith('#'):
+                next_block = ReferenceBlock.parse(l, self.gq_bands)
+
+            if block is not None and next_block is not None and block.is_mergeable(next_block):
+                block.merge(next_block)
+                self.fix_counts[REF_BLOCK_MERGE_FIX_NAME, block.cols[0]] += 1
+                continue
+
+            if block is not None:
+                yield block.to_line()
+            block = next_block
+            if block is None:
+                yield l
+
+        if block is not None:
+            yield block.to_line()
+
+    @staticmethod
+    def append_non_ref_af(sample, indices, allele_count):
+        """Append AF = AD[-1] / DP to a sample's AFs if NON_REF's is missing, returning None if nothing changed."""
+        ad_index, dp_index, af_index = indices
+        values = sample.rstrip('\n').split(':')
+        if len(values) <= max(indices) or values[af_index].count(',') + 1 != allele_count - 1:
+            return None
+
+        try:
+            af = f'{int(values[ad_index].rsplit(",", 1)[-1]) / int(values[dp_index]):.4f}'
+        except (ValueError, ZeroDivisionError):
+            af = '.'
+        values[af_index] = f'{values[af_index]},{af}'
+
+        return ':'.join(values) + sample[len(sample.rstrip('\n')):]
+
+class ReferenceBlock:
+    """A gVCF reference block, merged with the adjacent ones in the same GQ band."""
+
+    def __init__(self, l, cols, end, gq_band):
+        self.line = l
+        self.is_merged = False
+        self.cols = cols
+        self.end = end
+        self.gq_band = gq_band
+        self.keys = cols[8].split(':')
+        self.values = cols[9].split(':')
+
+    @classmethod
+    def parse(cls, l, gq_bands):
+        """Parse a reference block line, or get None if it is not one or has no GQ."""
+        cols = l.rstrip('\n').split('\t')
+        if len(cols) != 10 or cols[4] != NON_REF_ALT:
+            return None
+
+        end = int(cols[1])
+        for info_field in cols[7].split(';'):
+            if info_field.startswith('END='):
+                end = int(info_field[4:])
+
+        block = cls(l, cols, end, None)
+        gq = block.get_int_value('GQ')
+        if gq is None:
+            return None
+        block.gq_band = bisect.bisect_right(gq_bands, gq)
+        return block
+
+    def get_int_value(self, key):
+        try:
+            return int(self.values[self.keys.index(key)])
+        except (ValueError, IndexError):
+            return None
+
+    def is_mergeable(self, block):
+        # Blocks must abut with the same genotype, FORMAT and FILTER
+        return (block.cols[0] == self.cols[0] and int(block.cols[1]) == self.end + 1
+                and block.gq_band == self.gq_band and block.cols[8] == self.cols[8]
+                and block.cols[6] == self.cols[6] and block.values[0] == self.values[0])
+
+    def merge(self, block):
+        """Extend the block over an adjacent one, keeping the min. GQ, (MIN_)DP and PLs."""
+        self.end = block.end
+        self.is_merged = True
+        for key in REF_BLOCK_MIN_FIELDS:
+            value = self.get_int_value(key)
+            block_value = block.get_int_value(key)
+            if value is not None and block_value is not None and block_value < value:
+                self.values[self.keys.index(key)] = str(block_value)
+
+        if 'PL' in self.keys:
+            pl_index = self.keys.index('PL')
+            try:
+                pls = [int(p) for p in self.values[pl_index].split(',')]
+                block_pls = [int(p) for p in block.values[pl_index].split(',')]
+            except (ValueError, IndexError):
+                return
+            if len(pls) == len(block_pls):
+                self.values[pl_index] = ','.join(str(min(p, q)) for p, q in zip(pls, block_pls))
+
+    def to_line(self):
+        if not self.is_merged:
+            return self.line
+        info_fields = [f for f in self.cols[7].split(';') if not f.startswith('END=') and f != '.']
+        self.cols[7] = ';'.join([f'END={self.end}'] + info_fields)
+        self.cols[9] = ':'.join(self.values)
+        return '\t'.join(self.cols) + '\n'
+
+def show_fix_counts(fix_counts):
+    for fix_name in (REF_N_FIX_NAME, NON_REF_AF_FIX_NAME, REF_BLOCK_MERGE_FIX_NAME):
+        fix_name_counts = {contig: count for (name, contig), count in fix_counts.items() if name == fix_name}
+        for contig, count in fix_name_counts.items():
+            print(f'{fix_name} on {contig}: {count}')
+        print(f'{fix_name} in total: {sum(fix_name_counts.values())}')
+
+def write_fixed_gvcf_lines(writer, index_builder, lines, fixer):
+    for l in fixer.fix_lines(lines):
+        start_position = writer.tell()
+        writer.write(l.encode())
+        if not l.startswith('#'):
+            index_builder.add_vcf_line(l, start_position, writer.tell())
+
+def write_indexed_gvcf(src, output_gvcf, fixer):
+    with pysam.BGZFile(str(output_gvcf), 'wb') as dst:
+        for l in fixer.fix_lines(src):
+            dst.write(l.encode())
+    pysam.tabix_index(str(output_gvcf), preset='vcf', force=True)
+
+def is_gvcf_indexed(input_gvcf):
+    return any(pathlib.Path(f'{input_gvcf}{ext}').exists() for ext in ('.tbi', '.csi'))
+
+def get_header_ordered_contigs(header_lines, contigs):
+    """Order contigs as in the header, with any contigs missing from it last."""
+    header_contigs = [m.group(1) for m in map(CONTIG_HEADER_PATTERN.match, header_lines) if m is not None]
+    contig_ranks = {c: i for i, c in enumerate(header_contigs)}
+    return sorted(contigs, key=lambda c: contig_ranks.get(c, len(contig_ranks)))
+
+def init_gvcf_fix_worker(ref_fasta, contigs, gq_bands, is_non_ref_af_filled):
+    global worker_fixer
+    worker_fixer = GvcfLineFixer(ReferenceContigCache(ref_fasta), contigs, gq_bands, is_non_ref_af_filled)
+
+def fix_contig_gvcf(contig, input_gvcf, part_path):
+    """Fix the records of one contig into a BGZF part file, returning its fix counts."""
+    worker_fixer.fix_counts = Counter()
+    with pysam.TabixFile(str(input_gvcf)) as src, pysam.BGZFile(part_path, 'wb') as dst:
+        for l in worker_fixer.fix_lines(f'{l}\n' for l in src.fetch(contig)):
+            dst.write(l.encode())
+
+    return worker_fixer.fix_counts
+
+def write_indexed_gvcf_parallel(input_gvcf, output_gvcf, ref_fasta, fixed_contigs, gq_bands, is_non_ref_af_filled,
+                                threads):
+    """Fix contigs in a worker pool and concatenate their BGZF parts in header order."""
+    with pysam.TabixFile(str(input_gvcf)) as src:
+        header_lines = list(src.header)
+        contigs = get_header_ordered_contigs(header_lines, src.contigs)
+    header_path = f'{output_gvcf}.header.part'
+    part_paths = [f'{output_gvcf}.{i}.part' for i in range(len(contigs))]
+
+    with pysam.BGZFile(header_path, 'wb') as dst:
+        dst.write(''.join(f'{l}\n' for l in header_lines).encode())
+
+    with ProcessPoolExecutor(max_workers=threads, initializer=init_gvcf_fix_worker,
+                             initargs=(str(ref_fasta), fixed_contigs, gq_bands, is_non_ref_af_filled)) as executor:
+        contig_fix_counts = list(executor.map(fix_contig_gvcf, contigs, [input_gvcf] * len(contigs), part_paths))
+
+    concat_bgzf_files(output_gvcf, [header_path] + part_paths)
+    pysam.tabix_index(str(output_gvcf), preset='vcf', force=True)
+
+    fix_counts = Counter()
+    for part_fix_counts in contig_fix_counts:
+        fix_counts.update(part_fix_counts)
+    return fix_counts
+
+def get_bgzf_segments(contig_indices, data_size, is_contig_fixed):
+    """Split a BGZF file at contig starts into runs of [start, end, is fixed] virtual offsets, the header not being fixed."""
+    contig_starts = sorted((pseudo_bin_chunks[0][0], c) for c, _, _, pseudo_bin_chunks in contig_indices)
+    boundaries = [0] + [v for v, _ in contig_starts] + [data_size << 16]
+    fixed_flags = [False] + [is_contig_fixed(c) for _, c in contig_starts]
+
+    segments = []
+    for start, end, is_fixed in zip(boundaries[:-1], boundaries[1:], fixed_flags):
+        if len(segments) > 0 and segments[-1][2] == is_fixed:
+            segments[-1][1] = end
+        else:
+            segments.append([start, end, is_fixed])
+    return segments
+
+def copy_bgzf_segment(src_fh, writer, start, end):
+    """Copy a virtual offset range of a BGZF file, passing its whole blocks through as they are.
+
+    Returns a function mapping its virtual offsets to those in the output, once the writer is closed.
+    """
+    start_offset, start_within = start >> 16, start & 0xffff
+    end_offset, end_within = end >> 16, end & 0xffff
+    writer.flush()
+
+    if start_offset == end_offset:
+        head_position = writer.tell()
+        if end_within > start_within:
+            data, _ = read_bgzf_block(src_fh, start_offset)
+            writer.write(data[start_within:end_within])
+        return lambda v: writer.get_virtual_offset(head_position + (v & 0xffff) - start_within)
+
+    # Partly covered blocks at either end are recompressed, the ones in between copied
+    head_position = None
+    raw_start = start_offset
+    if start_within > 0:
+        data, raw_start = read_bgzf_block(src_fh, start_offset)
+        head_position = writer.tell()
+        writer.write(data[start_within:])
+    raw_offset = writer.append_bgzf_blocks(src_fh, raw_start, end_offset)
+    tail_position = writer.tell()
+    if end_within > 0:
+        data, _ = read_bgzf_block(src_fh, end_offset)
+        writer.write(data[:end_within])
+
+    def resolve_offset(v):
+        offset, within = v >> 16, v & 0xffff
+        if offset == start_offset and head_position is not None:
+            return writer.get_virtual_offset(head_position + within - start_within)
+        if offset == end_offset:
+            return writer.get_virtual_offset(tail_position + within)
+        return ((raw_offset + offset - raw_start) << 16) | within
+
+    return resolve_offset
+
+def iter_bgzf_segment_lines(src_fh, start, end):
+    """Iterate over the lines in a virtual offset range of a BGZF file."""
+    offset, within = start >> 16, start & 0xffff
+    end_offset, end_within = end >> 16, end & 0xffff
+    remainder = b''
+    while offset < end_offset or (offset == end_offset and within < end_within):
+        data, next_offset = read_bgzf_block(src_fh, offset)
+        if offset == end_offset:
+            data = data[:end_within]
+        data = remainder + data[within:]
+        split_pos = data.rfind(b'\n') + 1
+        remainder = data[split_pos:]
+        yield from (f'{l}\n' for l in data[:split_pos].decode().split('\n')[:-1])
+        offset, within = next_offset, 0
+    if len(remainder) > 0:
+        yield remainder.decode()
+
+def map_tabix_contig_index(contig_index, resolve_offset):
+    contig, bins, linear_offsets, pseudo_bin_chunks = contig_index
+    bins = {b: [[resolve_offset(v) for v in chunk] for chunk in chunks] for b, chunks in bins.items()}
+    linear_offsets = [resolve_offset(v) for v in linear_offsets]
+    # The pseudo-bin's second chunk holds record counts, not offsets
+    pseudo_bin_chunks = [[resolve_offset(v) for v in pseudo_bin_chunks[0]], pseudo_bin_chunks[1]]
+
+    return contig, bins, linear_offsets, pseudo_bin_chunks
+
+def write_indexed_gvcf_passthrough(input_gvcf, output_gvcf, fixer, threads):
+    """Fix only the contigs being fixed, copying the compressed blocks of the others and remapping their index."""
+    contig_indices, no_coor_count = read_tabix_index(f'{input_gvcf}.tbi')
+    if any(pseudo_bin_chunks is None for _, _, _, pseudo_bin_chunks in contig_indices):
+        sys.exit(f'Index file \'{input_gvcf}.tbi\' has no contig offsets to pass blocks through')
+
+    # The input index is remapped rather than rebuilt by htslib, as tabix would decompress the whole output
+    writer = BgzfWriter(output_gvcf, threads)
+    index_builder = TabixIndexBuilder()
+    segment_starts = []
+    segment_offset_resolvers = []
+    with open(input_gvcf, 'rb') as src_fh:
+        segments = get_bgzf_segments(contig_indices, get_bgzf_data_size(src_fh), fixer.is_contig_changed)
+        for start, end, is_fixed in segments:
+            if is_fixed:
+                write_fixed_gvcf_lines(writer, index_builder, iter_bgzf_segment_lines(src_fh, start, end), fixer)
+            else:
+                segment_starts.append(start)
+                segment_offset_resolvers.append(copy_bgzf_segment(src_fh, writer, start, end))
+    writer.close()
+
+    # Chunk ends at a segment end belong to the passed through segment before it
+    def resolve_offset(v):
+        return segment_offset_resolvers[bisect.bisect_right(segment_starts, v) - 1](v)
+
+    contig_indices = sorted(contig_indices, key=lambda c: c[3][0][0])
+    write_tabix_index(f'{output_gvcf}.tbi', [
+        (c[0], *index_builder.get_contig_index(c[0], writer.get_virtual_offset)) if fixer.is_contig_changed(c[0])
+        else map_tabix_contig_index(c, resolve_offset)
+        for c in contig_indices], no_coor_count)
+
 def main():
     args = parse_arguments()
 
     if not pathlib.Path(f'{args.ref_fasta}.fai').exists():
         sys.exit(f'Index file does not exist for \'{args.ref_fasta}\'')
 
-    ref_seq = pysam.FastaFile(args.ref_fasta)
+    is_output_bgzf = str(args.output_gvcf).endswith(".gz")
+    fixed_contigs = None if args.is_all_contigs else args.contigs
 
-    with smart_open(args.input_gvcf) as src, smart_open(args.output_gvcf, "w") as dst:
-        for l in src:
-            if l.startswith("chrY\t"):
-                t = l.split('\t')
-                if t[3] == "N":
-                    pos = int(t[1])
-                    t[3] = ref_seq.fetch("chrY", pos - 1, pos)
-                    l = '\t'.join(t)
-            dst.write(l)
+    # Contigs can only be fixed in parallel with an indexed input
+    if (not args.is_passthrough and is_output_bgzf and args.threads > 1
+            and is_gvcf_indexed(args.input_gvcf)):
+        show_fix_counts(write_indexed_gvcf_parallel(
+            args.input_gvcf, args.output_gvcf, args.ref_fasta, fixed_contigs, args.gq_bands,
+            args.is_non_ref_af_filled, args.threads))
+        return
 
-    ref_seq.close()
+    fixer = GvcfLineFixer(ReferenceContigCache(args.ref_fasta), fixed_contigs, args.gq_bands, args.is_non_ref_af_filled)
+
+    if args.is_passthrough and is_output_bgzf and pathlib.Path(f'{args.input_gvcf}.tbi').exists():
+        write_indexed_gvcf_passthrough(args.input_gvcf, args.output_gvcf, fixer, args.threads)
+    else:
+        with smart_open(args.input_gvcf) as src:
+            if is_output_bgzf:
+                write_indexed_gvcf(src, args.output_gvcf, fixer)
+            else:
+                with open(args.output_gvcf, "w") as dst:
+                    dst.writelines(fixer.fix_lines(src))
+
+    fixer.ref_contigs.close()
+    show_fix_counts(fixer.fix_counts)
 
 if __name__ == '__main__':
     main()
-
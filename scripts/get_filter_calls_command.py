@@ -1,30 +1,394 @@
 #!/usr/bin/env python
-"""Construct SV call filtering command."""
+"""Construct SV call filtering command, or apply the filter in-process."""
 
 import argparse
 import gzip
+import io
+import json
+import os
+import re
 import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pysam
+
+from bgzf_tabix import concat_bgzf_files
+from depth_bed_index import load_depth_bed_index, lookup_depths
+from target_bed_index import is_pos_in_targets, load_target_bed_index
 
 threshold_lookup = ['0'] + ['2'] * 10 + ['3'] * 9 + ['5'] * 20 + ['8'] * 100
 
+DEPTH_BED_CHUNK_SIZE = 64 * 1024 * 1024
+AVG_DEPTH_CACHE_SUFFIX = '.avg_depth.json'
 
-def calculate_average_depth(path):
-    """Get the average read depth."""
-    with gzip.open(path, "r") as fh:
-        sum_depth = 0
-        count_depth = 0
-        total_size = 0
+# Mate position in BND ALTs such as 'N[chr2:1000[' or ']chr2:1000]N'
+BND_MATE_PATTERN = re.compile(r'[\[\]](.+):(\d+)[\[\]]')
+INFO_END_PATTERN = re.compile(rb'(?:^|;)END=(\d+)')
+
+
+def get_mosdepth_summary_path(path):
+    """Get the mosdepth summary file written alongside a regions BED."""
+    for bed_suffix in ['.regions.bed.gz', '.per-base.bed.gz']:
+        if path.endswith(bed_suffix):
+            return path[:-len(bed_suffix)] + '.mosdepth.summary.txt'
+    return None
+
+
+def read_mosdepth_summary_depth(path):
+    """Get the average depth from a mosdepth summary, if present."""
+    if path is None or not os.path.exists(path):
+        return None
+
+    # The 'total_region' row only exists when mosdepth was run with --by
+    summary_depths = {}
+    with open(path) as fh:
+        header = fh.readline().rstrip('\n').split('\t')
         for line in fh:
-            if not line:
+            cols = dict(zip(header, line.rstrip('\n').split('\t')))
+            summary_depths[cols['chrom']] = float(cols['mean'])
+    return summary_depths.get('total_region', summary_depths.get('total'))
+
+
+def read_bed_average_depth(path):
+    """Get the length-weighted average depth of a depth BED."""
+    sum_depth = 0.0
+    total_size = 0
+    remainder = b''
+    with gzip.open(path, "rb") as fh:
+        while True:
+            chunk = fh.read(DEPTH_BED_CHUNK_SIZE)
+            if not chunk:
+                chunk = remainder
+                remainder = b''
+            else:
+                chunk = remainder + chunk
+                split_pos = chunk.rfind(b'\n') + 1
+                chunk, remainder = chunk[:split_pos], chunk[split_pos:]
+            if not chunk.strip():
+                if not remainder:
+                    break
                 continue
-            cols = line.strip().split(b"\t")
-            sum_depth += float(cols[3]) * int(cols[2])
-            total_size += int(cols[2])
-            count_depth += 1
-    avg_depth = sum_depth / total_size
+            cols = np.loadtxt(
+                io.BytesIO(chunk), delimiter='\t', usecols=(1, 2, 3),
+                ndmin=2)
+            sizes = cols[:, 1] - cols[:, 0]
+            sum_depth += float(np.dot(cols[:, 2], sizes))
+            total_size += int(sizes.sum())
+    return sum_depth / total_size
+
+
+def calculate_average_depth(path):
+    """Get the average read depth."""
+    # Cached next to the BED, keyed on its path, size and mtime
+    bed_stat = os.stat(path)
+    cache_key = {
+        'path': os.path.abspath(path),
+        'size': bed_stat.st_size,
+        'mtime_ns': bed_stat.st_mtime_ns
+    }
+    cache_path = path + AVG_DEPTH_CACHE_SUFFIX
+    try:
+        with open(cache_path) as fh:
+            cache = json.load(fh)
+        if cache.get('key') == cache_key:
+            return cache['avg_depth']
+    except (OSError, ValueError):
+        pass
+
+    avg_depth = read_mosdepth_summary_depth(get_mosdepth_summary_path(path))
+    if avg_depth is None:
+        avg_depth = read_bed_average_depth(path)
+
+    try:
+        with open(cache_path, 'w') as fh:
+            json.dump({'key': cache_key, 'avg_depth': avg_depth}, fh)
+    except OSError:
+        pass
     return avg_depth
 
 
+def get_bnd_mate(record):
+    """Get the mate breakend (contig, pos) from a BND ALT, if it has one."""
+    if not record.alts:
+        return None
+    match = BND_MATE_PATTERN.search(record.alts[0])
+    if match is None:
+        return None
+    return match.group(1), int(match.group(2))
+
+
+def is_sv_call_in_targets(record, targets, target_bnd_mode='pos'):
+    """Check an SV call against the targets, optionally on both BND breakends."""
+    is_pos_in = is_pos_in_targets(targets, record.chrom, record.pos)
+    if target_bnd_mode == 'pos' or record.info.get('SVTYPE') != 'BND':
+        return is_pos_in
+
+    # Breakends without a parsable mate are judged on POS alone
+    mate = get_bnd_mate(record)
+    if mate is None:
+        return is_pos_in
+    is_mate_in = is_pos_in_targets(targets, *mate)
+    if target_bnd_mode == 'either':
+        return is_pos_in or is_mate_in
+    return is_pos_in and is_mate_in
+
+
+def get_info_numbers(record, key):
+    """Get the numeric values of an INFO field as a tuple."""
+    value = record.info.get(key)
+    if value is None:
+        return ()
+    if not isinstance(value, tuple):
+        value = (value,)
+    return tuple(v for v in value if v is not None)
+
+
+def is_sv_call_retained(
+        record, sv_types, min_read_support, min_sv_length, max_sv_length,
+        is_BND_incl):
+    """Apply the same rules as the generated `bcftools view -i` filter."""
+    # As in bcftools, a comparison on a missing value fails, and a
+    # comparison on a vector passes if any of its values does
+    sv_type = record.info.get('SVTYPE')
+    if min_read_support is not None and not any(
+            s >= min_read_support
+            for s in get_info_numbers(record, 'SUPPORT')):
+        return False
+
+    if is_BND_incl and sv_type == 'BND':
+        return True
+
+    if sv_type not in sv_types:
+        return False
+
+    sv_lengths = [abs(s) for s in get_info_numbers(record, 'SVLEN')]
+    if min_sv_length > 0 and not any(s >= min_sv_length for s in sv_lengths):
+        return False
+    if max_sv_length > 0 and not any(s <= max_sv_length for s in sv_lengths):
+        return False
+    return True
+
+
+def add_support_header(header):
+    """Declare INFO/SUPPORT, for calls whose support is counted from RNAMES."""
+    if 'SUPPORT' not in header.info:
+        header.info.add(
+            'SUPPORT', 1, 'Integer',
+            'Number of reads supporting the structural variation')
+
+
+def annotate_support_from_rnames(record):
+    """Set a missing INFO/SUPPORT to the number of reads in INFO/RNAMES."""
+    if 'SUPPORT' in record.info:
+        return
+
+    rnames = record.info.get('RNAMES')
+    if rnames is None:
+        record.info['SUPPORT'] = 0
+        return
+
+    # With a Number=1 header, RNAMES comes back as one comma-separated string
+    if isinstance(rnames, str):
+        rnames = tuple(rnames.split(','))
+    if any(not rname for rname in rnames):
+        sys.exit(
+            f'Malformed INFO/RNAMES (empty read name) in SV call '
+            f'\'{record.id}\' at {record.chrom}:{record.pos}: '
+            f'RNAMES={",".join(r or "" for r in rnames)}')
+    record.info['SUPPORT'] = len(rnames)
+
+
+def get_sv_call_breakpoints(record, line):
+    """Get the (contig, pos) breakpoints of an SV call."""
+    breakpoints = [(record.chrom, record.pos)]
+    sv_type = record.info.get('SVTYPE')
+    if sv_type == 'BND':
+        mate = get_bnd_mate(record)
+        if mate is not None:
+            breakpoints.append(mate)
+    elif sv_type != 'INS':
+        # pysam hides INFO/END, and its stop may also be extended by SVLEN
+        end_match = INFO_END_PATTERN.search(line.split(b'\t', 8)[7])
+        if end_match is not None:
+            end = int(end_match.group(1))
+        else:
+            sv_lengths = get_info_numbers(record, 'SVLEN')
+            end = record.pos + abs(sv_lengths[0]) if sv_lengths else 0
+        if end > record.pos:
+            breakpoints.append((record.chrom, end))
+    return breakpoints
+
+
+def get_local_min_read_supports(
+        depth_index, avg_depth, min_read_support_limit, breakpoints_list):
+    """Get per-call support cutoffs from the mean depth at their breakpoints."""
+    call_ids = np.repeat(
+        np.arange(len(breakpoints_list)),
+        [len(b) for b in breakpoints_list])
+    breakpoints = [bp for b in breakpoints_list for bp in b]
+    depths = lookup_depths(
+        depth_index, [bp[0] for bp in breakpoints],
+        [bp[1] for bp in breakpoints]).astype(np.float64)
+
+    # Calls with no breakpoint in a depth window use the average depth
+    is_covered = ~np.isnan(depths)
+    depth_sums = np.bincount(
+        call_ids[is_covered], weights=depths[is_covered],
+        minlength=len(breakpoints_list))
+    depth_counts = np.bincount(
+        call_ids[is_covered], minlength=len(breakpoints_list))
+    call_depths = np.full(len(breakpoints_list), avg_depth)
+    np.divide(depth_sums, depth_counts, out=call_depths,
+              where=depth_counts > 0)
+
+    call_depths = np.minimum(call_depths, len(threshold_lookup) - 1)
+    thresholds = np.array(threshold_lookup, dtype=np.int64)[
+        np.round(call_depths).astype(np.int64)]
+    return np.maximum(thresholds, min_read_support_limit)
+
+
+def get_vcfsort_contig_key(contig):
+    """Get the sort key of a contig under `sort -k1,1d` (C locale)."""
+    # Dictionary order ignores everything but blanks and alphanumerics
+    return re.sub(rb'[^A-Za-z0-9 \t]', b'', contig)
+
+
+def get_vcfsort_key(line):
+    """Get the sort key of a VCF line under `sort -k1,1d -k2,2n` (C locale)."""
+    cols = line.split(b'\t', 2)
+    return get_vcfsort_contig_key(cols[0]), int(cols[1]), line
+
+
+def get_retained_sv_call_lines(
+        records, targets, sv_types, min_read_support, min_sv_length,
+        max_sv_length, is_BND_incl, target_bnd_mode='pos',
+        local_depth_args=None, is_support_from_rnames=False):
+    """Get the sorted VCF lines of the SV calls passing the filter."""
+    # With local depth, the support cutoff is applied once all calls are
+    # read, so that breakpoint depths are looked up in one go
+    if local_depth_args is not None:
+        min_read_support = None
+
+    lines = []
+    supports = []
+    breakpoints_list = []
+    for record in records:
+        if targets is not None and not is_sv_call_in_targets(
+                record, targets, target_bnd_mode):
+            continue
+        if is_support_from_rnames:
+            annotate_support_from_rnames(record)
+        if is_sv_call_retained(
+                record, sv_types, min_read_support, min_sv_length,
+                max_sv_length, is_BND_incl):
+            lines.append(str(record).encode())
+            if local_depth_args is not None:
+                supports.append(max(
+                    get_info_numbers(record, 'SUPPORT'), default=-1))
+                breakpoints_list.append(
+                    get_sv_call_breakpoints(record, lines[-1]))
+
+    if local_depth_args is not None and len(lines) > 0:
+        depth_bedfile, avg_depth, min_read_support_limit = local_depth_args
+        min_read_supports = get_local_min_read_supports(
+            load_depth_bed_index(depth_bedfile), avg_depth,
+            min_read_support_limit, breakpoints_list)
+        is_supported = np.array(supports) >= min_read_supports
+        lines = [line for line, s in zip(lines, is_supported) if s]
+
+    lines.sort(key=get_vcfsort_key)
+    return lines
+
+
+def init_sv_filter_worker(targets):
+    global worker_targets
+    worker_targets = targets
+
+
+def filter_contig_sv_calls(
+        contig, part_path, vcf_path, sv_filter_args, is_lines_returned):
+    """Filter the SV calls of one contig into a BGZF part file."""
+    with pysam.VariantFile(vcf_path) as src:
+        if sv_filter_args[-1]:
+            add_support_header(src.header)
+        lines = get_retained_sv_call_lines(
+            src.fetch(contig), worker_targets, *sv_filter_args)
+
+    with pysam.BGZFile(part_path, 'wb') as dst:
+        dst.write(b''.join(lines))
+
+    return lines if is_lines_returned else None
+
+
+def filter_sv_calls(
+        vcf_path, output_path, output_vcf_path, targets, sv_types,
+        min_read_support, min_sv_length, max_sv_length, is_BND_incl,
+        command_line, threads=1, target_bnd_mode='pos',
+        local_depth_args=None, is_support_from_rnames=False):
+    """Filter SV calls and write sorted BGZF VCF and its index."""
+    sv_filter_args = (
+        sv_types, min_read_support, min_sv_length, max_sv_length,
+        is_BND_incl, target_bnd_mode, local_depth_args,
+        is_support_from_rnames)
+
+    with pysam.VariantFile(vcf_path) as src:
+        if is_support_from_rnames:
+            add_support_header(src.header)
+        src.header.add_line(f'##filter_sv_callsCommand={command_line}')
+        header = str(src.header).encode()
+
+        # Contigs can only be filtered in parallel with an indexed input
+        contigs = None
+        if threads > 1 and src.index is not None:
+            contigs = list(src.index)
+        else:
+            lines = get_retained_sv_call_lines(
+                src, targets, *sv_filter_args)
+
+    if contigs is None:
+        with pysam.BGZFile(output_path, 'wb') as dst:
+            dst.write(header)
+            dst.write(b''.join(lines))
+    else:
+        lines = filter_sv_calls_parallel(
+            vcf_path, output_path, header, contigs, targets, sv_filter_args,
+            output_vcf_path is not None, threads)
+    pysam.tabix_index(output_path, preset='vcf', force=True)
+
+    if output_vcf_path is not None:
+        with open(output_vcf_path, 'wb') as fh:
+            fh.write(header)
+            fh.writelines(lines)
+
+
+def filter_sv_calls_parallel(
+        vcf_path, output_path, header, contigs, targets, sv_filter_args,
+        is_lines_returned, threads):
+    """Filter contigs in a worker pool and concatenate their BGZF parts."""
+    # Parts are concatenated in the same contig order the serial sort gives
+    contigs = sorted(contigs, key=lambda c: get_vcfsort_contig_key(c.encode()))
+    header_path = f'{output_path}.header.part'
+    part_paths = [f'{output_path}.{i}.part' for i in range(len(contigs))]
+
+    with pysam.BGZFile(header_path, 'wb') as dst:
+        dst.write(header)
+
+    with ProcessPoolExecutor(
+            max_workers=threads, initializer=init_sv_filter_worker,
+            initargs=(targets,)) as executor:
+        contig_lines = list(executor.map(
+            filter_contig_sv_calls, contigs, part_paths,
+            [vcf_path] * len(contigs), [sv_filter_args] * len(contigs),
+            [is_lines_returned] * len(contigs)))
+
+    concat_bgzf_files(output_path, [header_path] + part_paths)
+
+    if not is_lines_returned:
+        return []
+    return [line for part_lines in contig_lines for line in part_lines]
+
+
 def parse_arguments():
     """Parse the command line arguments."""
     parser = argparse.ArgumentParser()
@@ -92,6 +456,66 @@ def parse_arguments():
         nargs="+"
     )
 
+    parser.add_argument(
+        "--output",
+        help=(
+            "Filter the calls in-process and write them to this sorted,"
+            " bgzipped and tabix-indexed VCF path instead of running the"
+            " printed bcftools command."
+        ),
+        required=False
+    )
+
+    parser.add_argument(
+        "--output_vcf",
+        help=(
+            "Also write the filtered calls as an uncompressed VCF"
+            " (with --output)."
+        ),
+        required=False
+    )
+
+    parser.add_argument(
+        "--target_bnd_mode",
+        help=(
+            "Check BND calls against the target bedfile at POS only"
+            " (as bcftools -T), at either breakend, or at both breakends"
+            " (with --output)."
+        ),
+        choices=["pos", "either", "both"],
+        default="pos"
+    )
+
+    parser.add_argument(
+        "--local_depth",
+        help=(
+            "With --min_read_support auto, pick each call's read support"
+            " cutoff from the depth at its breakpoints rather than the"
+            " average depth (with --output)."
+        ),
+        action="store_true"
+    )
+
+    parser.add_argument(
+        "--support_from_rnames",
+        help=(
+            "Set INFO/SUPPORT of calls lacking it to the number of reads"
+            " in INFO/RNAMES, e.g. for cuteSV --report_readid output"
+            " (with --output)."
+        ),
+        action="store_true"
+    )
+
+    parser.add_argument(
+        "--threads",
+        help=(
+            "Set the number of processes for filtering contigs of an"
+            " indexed VCF in parallel (with --output)."
+        ),
+        default=1,
+        type=int
+    )
+
     return parser.parse_args()
 
 
@@ -101,12 +525,14 @@ def main():
 
     # Get SV type filters
     sv_type_filters = []
+    sv_types = set()
     is_BND_incl = False
     for svtype in args.sv_types:
         if svtype == 'BND':
             is_BND_incl = True
         else:
             sv_type_filters.append(f'SVTYPE = \"{svtype}\"')
+            sv_types.add(svtype)
     filter_sv_types = f"( {(' || ').join(sv_type_filters)} )"
 
     # Get length filters
@@ -123,8 +549,14 @@ def main():
     # Get min read support filter
     # Todo: Check this
     min_read_support = args.min_read_support_limit
+    local_depth_args = None
     if args.min_read_support in ['auto']:
         avg_depth = calculate_average_depth(args.depth_bedfile)
+        if args.local_depth and args.output:
+            # Built here once, so parallel contig workers only map it
+            load_depth_bed_index(args.depth_bedfile)
+            local_depth_args = (
+                args.depth_bedfile, avg_depth, args.min_read_support_limit)
         avg_depth = min(avg_depth, len(threshold_lookup) - 1)
         detected_read_support = int(threshold_lookup[round(avg_depth)])
 
@@ -165,6 +597,17 @@ def main():
     command = f"bcftools view {filter_string} {args.vcf}"
     sys.stdout.write(command)
 
+    if args.output:
+        targets = None
+        if args.target_bedfile:
+            targets = load_target_bed_index(args.target_bedfile)
+        filter_sv_calls(
+            args.vcf, args.output, args.output_vcf, targets, sv_types,
+            min_read_support, args.min_sv_length, args.max_sv_length,
+            is_BND_incl, ' '.join(sys.argv), args.threads,
+            args.target_bnd_mode, local_depth_args,
+            args.support_from_rnames)
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""Build and query cached, merged per-contig interval indexes of target BED files."""
+
+import argparse
+import gzip
+import os
+import sys
+
+import numpy as np
+
+TARGET_BED_INDEX_VERSION = 1
+TARGET_BED_INDEX_SUFFIX = '.intervals.npz'
+
+
+def smart_open(fn, mode="rt"):
+    if str(fn).endswith(".gz"):
+        return gzip.open(fn, mode)
+    else:
+        return open(fn, mode)
+
+
+def parse_target_bed(path):
+    """Get merged, sorted 0-based half-open target intervals per contig."""
+    contig_intervals = {}
+    with smart_open(path) as fh:
+        for line in fh:
+            if line.startswith(('#', 'track', 'browser')) or not line.strip():
+                continue
+            cols = line.rstrip('\n').split('\t')
+            contig_intervals.setdefault(cols[0], []).append(
+                (int(cols[1]), int(cols[2])))
+
+    index = {}
+    for contig, intervals in contig_intervals.items():
+        intervals = np.array(sorted(intervals), dtype=np.int64)
+        starts = intervals[:, 0]
+        ends = np.maximum.accumulate(intervals[:, 1])
+        # A new merged interval begins wherever a start is past all ends so far
+        is_new = np.ones(len(starts), dtype=bool)
+        is_new[1:] = starts[1:] > ends[:-1]
+        group_ends = np.append(np.flatnonzero(is_new)[1:] - 1, len(starts) - 1)
+        index[contig] = (starts[is_new], ends[group_ends])
+    return index
+
+
+def get_target_bed_index_path(path):
+    return f'{path}{TARGET_BED_INDEX_SUFFIX}'
+
+
+def save_target_bed_index(index, path, index_path):
+    bed_stat = os.stat(path)
+    contigs = list(index.keys())
+    # Written aside and moved into place, as samples may load it concurrently
+    tmp_index_path = f'{index_path}.{os.getpid()}.tmp'
+    with open(tmp_index_path, 'wb') as fh:
+        np.savez(
+            fh,
+            version=TARGET_BED_INDEX_VERSION,
+            bed_size=bed_stat.st_size,
+            bed_mtime_ns=bed_stat.st_mtime_ns,
+            contigs=np.array(contigs, dtype=str),
+            offsets=np.cumsum([0] + [len(index[c][0]) for c in contigs]),
+            starts=np.concatenate([index[c][0] for c in contigs] + [np.empty(0, dtype=np.int64)]),
+            ends=np.concatenate([index[c][1] for c in contigs] + [np.empty(0, dtype=np.int64)]))
+    os.replace(tmp_index_path, index_path)
+
+
+def read_target_bed_index(path, index_path):
+    """Read a cached index, or None if it is missing or older than the BED."""
+    try:
+        cache = np.load(index_path)
+    except (OSError, ValueError):
+        return None
+
+    with cache:
+        bed_stat = os.stat(path)
+        if (int(cache['version']) != TARGET_BED_INDEX_VERSION
+                or int(cache['bed_size']) != bed_stat.st_size
+                or int(cache['bed_mtime_ns']) != bed_stat.st_mtime_ns):
+            return None
+
+        offsets = cache['offsets']
+        starts = cache['starts']
+        ends = cache['ends']
+        return {
+            str(contig): (starts[offsets[i]:offsets[i + 1]], ends[offsets[i]:offsets[i + 1]])
+            for i, contig in enumerate(cache['contigs'])}
+
+
+def load_target_bed_index(path, index_path=None):
+    """Get the interval index of a target BED, building and caching it on first use."""
+    if index_path is None:
+        index_path = get_target_bed_index_path(path)
+
+    index = read_target_bed_index(path, index_path)
+    if index is None:
+        index = parse_target_bed(path)
+        # The cache is only an optimisation, e.g. designs may be read-only
+        try:
+            save_target_bed_index(index, path, index_path)
+        except OSError:
+            pass
+    return index
+
+
+def is_pos_in_targets(index, contig, pos):
+    """Check a 1-based position falls in a target, like `bcftools -T`."""
+    if contig not in index:
+        return False
+    starts, ends = index[contig]
+    # BED intervals are 0-based half-open, so POS is in (start, end]
+    i = np.searchsorted(ends, pos, side='left')
+    return i < len(starts) and starts[i] < pos
+
+
+def main():
+    """Prebuild the interval index of target BEDs, e.g. once per design."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "bedfiles",
+        help="Target BED file paths",
+        nargs="+"
+    )
+    args = parser.parse_args()
+
+    for path in args.bedfiles:
+        index = load_target_bed_index(path)
+        interval_count = sum(len(starts) for starts, _ in index.values())
+        sys.stdout.write(
+            f"{path}: {interval_count} merged intervals on {len(index)} contigs\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,46 @@
 #!/usr/bin/env python3
 
 from argparse import ArgumentParser
+from bisect import bisect_right
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from functools import partial
+from itertools import islice
 from os import cpu_count
 from pathlib import Path, PurePosixPath
+import h5py
+import json
 import numpy as np
+import os
 import pod5
 import pysam
 import random
 import re
-import shlex
-import subprocess
 import sys
-
-ONT_FAST5_SUBSET_TOOL_PATH = '/group/bioi1/jimmyc/conda/envs/python39/lib/python3.9/site-packages/ont_fast5_api/conversion_tools/fast5_subset.py'
+import time
 
 FAST5_FILE_EXT = '.fast5'
 POD5_FILE_EXT = '.pod5'
+READ_FILE_TYPES = {FAST5_FILE_EXT: 'fast5', POD5_FILE_EXT: 'pod5'}
+READ_FILE_MANIFEST_VERSION = 1
+FAST5_READS_PER_FILE = 4000
+
+ALIGN_SCAN_REGION_SIZE = 10_000_000
+READ_ID_CHUNK_SIZE = 1_000_000
+
+# Read Ids are stored as packed 16-byte UUIDs alongside the max. read length seen for each read
+READ_ID_RECORD_DTYPE = np.dtype([('uuid', 'S16'), ('max_len', np.uint32)])
+
+# Read file index: sorted read UUIDs plus the file/batch/row each read is stored at
+READ_FILE_INDEX_VERSION = 2
+READ_FILE_INDEX_META_FILE_NAME = 'index.json'
+READ_FILE_INDEX_UUIDS_FILE_NAME = 'read_ids.npy'
+READ_FILE_INDEX_LOCATIONS_FILE_NAME = 'read_locations.npy'
+READ_LOCATION_DTYPE = np.dtype([('file_index', np.uint32), ('batch_index', np.uint32), ('batch_row', np.uint32)])
+
+# Read length histogram: log2-spaced bins, each octave split into equal-ratio sub-bins
+READ_STATS_FILE_EXT = '.stats.json'
+READ_LEN_HIST_BINS_PER_OCTAVE = 16
+READ_LEN_HIST_BIN_COUNT = 32 * READ_LEN_HIST_BINS_PER_OCTAVE
 
 def is_input_chrom_valid(chrom):
     return re.match(r'^(chr)?([1-9]|1[0-9]{1}|2[012]{1}|[XYM])$', chrom) is not None
@@ -32,70 +57,596 @@ def is_subsample_val_int(subsample_val):
 def is_subsample_val_valid(subsample_val):
     return (is_subsample_val_float(subsample_val) or is_subsample_val_int(subsample_val))
 
+def parse_subsample_val(subsample_val):
+    if not is_subsample_val_valid(subsample_val):
+        return None
+
+    if is_subsample_val_float(subsample_val):
+        return float(subsample_val)
+
+    return int(subsample_val)
+
 def create_non_exist_dir(dir_path):
     target_dir = Path(dir_path)
     if not target_dir.is_dir():
         target_dir.mkdir(mode=0o770, parents=True, exist_ok=True)
 
-def extract_read_ids_for_target_chrom(align_file_path, target_chrom=None, min_map_qual=0, is_primary_align_only=False,
-                                      is_include_unmapped_read=False, is_show_read_stats=True):
+def is_read_id_uuid(read_id):
+    uuid_hex_str = read_id.replace('-', '')
+    try:
+        return len(uuid_hex_str) == 32 and len(bytes.fromhex(uuid_hex_str)) == 16
+    except ValueError:
+        return False
+
+def read_ids_to_uuids(read_ids):
+    uuid_hex_strs = [read_id.replace('-', '') for read_id in read_ids]
+    if all(len(uuid_hex_str) == 32 for uuid_hex_str in uuid_hex_strs):
+        try:
+            return np.frombuffer(bytes.fromhex(''.join(uuid_hex_strs)), dtype='S16')
+        except ValueError:
+            pass
+
+    # Only looked up on failure, e.g. dorado duplex 'uuid;uuid' names or a header line in a read Id file
+    invalid_read_id = next(read_id for read_id in read_ids if not is_read_id_uuid(read_id))
+    sys.exit(f'Read Id \'{invalid_read_id}\' is not in UUID format (e.g. 0a1b2c3d-4e5f-6789-abcd-ef0123456789).')
+
+def uuids_to_read_ids(uuids):
+    uuid_hex_str = np.ascontiguousarray(uuids).tobytes().hex()
+    read_ids = list()
+
+    for i in range(0, len(uuid_hex_str), 32):
+        h = uuid_hex_str[i:i + 32]
+        read_ids.append(f'{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}')
+
+    return read_ids
+
+def create_read_id_records(read_ids, read_lens=None):
+    read_id_records = np.empty(len(read_ids), dtype=READ_ID_RECORD_DTYPE)
+    read_id_records['uuid'] = read_ids_to_uuids(read_ids)
+    read_id_records['max_len'] = 0 if read_lens is None else read_lens
+
+    return read_id_records
+
+def dedup_read_id_records(read_id_records):
+    # Sort by UUID with the longest length first within each UUID, then keep the first record of each UUID
+    read_id_records = read_id_records[np.argsort(read_id_records['max_len'], kind='stable')[::-1]]
+    read_id_records = read_id_records[np.argsort(read_id_records['uuid'], kind='stable')]
+    _, first_indices = np.unique(read_id_records['uuid'], return_index=True)
+
+    return read_id_records[first_indices]
+
+def merge_read_id_records(read_id_record_chunks):
+    if len(read_id_record_chunks) == 0:
+        return np.empty(0, dtype=READ_ID_RECORD_DTYPE)
+
+    return dedup_read_id_records(np.concatenate(read_id_record_chunks))
+
+def mix_uint64(x):
+    # SplitMix64 finaliser; uint64 array arithmetic wraps around silently
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+def get_read_uuid_hashes(uuids, seed=None):
+    uuid_halves = np.frombuffer(np.ascontiguousarray(uuids).tobytes(), dtype='>u8').astype(np.uint64).reshape(-1, 2)
+    seed_val = np.uint64(0 if seed is None else seed % 2**64)
+
+    return mix_uint64(uuid_halves[:, 0] ^ mix_uint64(uuid_halves[:, 1] ^ seed_val))
+
+def hash_subsample_read_id_records(read_id_records, subsample_val, seed=None):
+    # A read is kept based on its UUID hash alone, so the selection does not depend on the input order, the number of
+    # workers or whether the reads come from a BAM file or a read Id file. read_id_records must be deduplicated.
+    read_hashes = get_read_uuid_hashes(read_id_records['uuid'], seed)
+
+    if subsample_val < 1:
+        return read_id_records[read_hashes < np.uint64(min(int(subsample_val * 2**64), 2**64 - 1))]
+
+    # Keep the reads with the lowest hashes, which is a fixed-size reservoir of the full set
+    if len(read_id_records) <= subsample_val:
+        return read_id_records
+
+    return read_id_records[np.sort(np.argpartition(read_hashes, subsample_val - 1)[:subsample_val])]
+
+def open_align_file(align_file_path):
     align_file_ext = PurePosixPath(align_file_path).suffix
     if align_file_ext == '.bam':
-        src_align = pysam.AlignmentFile(align_file_path, 'rb')
+        return pysam.AlignmentFile(align_file_path, 'rb')
     elif align_file_ext == '.cram':
-        src_align = pysam.AlignmentFile(align_file_path, 'rc')
-    else:
-        print(f'Alignment file type unknown for \'{align_file_path}\'.')
-        return list()
+        return pysam.AlignmentFile(align_file_path, 'rc')
+
+    print(f'Alignment file type unknown for \'{align_file_path}\'.')
+    return None
+
+def iter_target_aligned_reads(src_align, target_chrom=None, is_include_unmapped_read=False):
+    # Use the BAI/CRAI index to jump straight to the target contig (and to the unmapped tail, if requested)
+    # instead of decompressing the whole alignment file. Fall back to a full pass if there is no index.
+    # Unmapped reads placed on other contigs (e.g. next to their mapped mate) are then not visited.
+    if target_chrom is None or not src_align.has_index():
+        yield from src_align.fetch(until_eof=True)
+        return
+
+    yield from src_align.fetch(target_chrom)
+
+    if is_include_unmapped_read:
+        yield from src_align.fetch('*')
+
+def get_aligned_read_filter_reason(aligned_read, target_chrom=None, min_map_qual=0, is_primary_align_only=False,
+                                   is_include_unmapped_read=False):
+    if aligned_read.is_unmapped:
+        return None if is_include_unmapped_read else 'unmapped'
+
+    if target_chrom is not None and aligned_read.reference_name != target_chrom:
+        return 'off_target_chrom'
+
+    if is_primary_align_only and (aligned_read.is_secondary or aligned_read.is_supplementary):
+        return 'non_primary_align'
+
+    return None if aligned_read.mapping_quality >= min_map_qual else 'low_map_qual'
+
+def merge_read_drop_counts(read_drop_counts_list):
+    merged_read_drop_counts = dict()
+    for read_drop_counts in read_drop_counts_list:
+        for filter_reason, read_drop_count in read_drop_counts.items():
+            merged_read_drop_counts[filter_reason] = merged_read_drop_counts.get(filter_reason, 0) + read_drop_count
+
+    return merged_read_drop_counts
+
+class ReadStatsAccumulator:
+    """Online read length statistics (Welford/Chan mean and variance, log-binned histogram) plus per-filter drop counts."""
+
+    def __init__(self, hash_subsample_val=None, seed=None):
+        # Only a fractional hash subsample can be applied per read while streaming
+        self.hash_subsample_val = hash_subsample_val if hash_subsample_val is not None and hash_subsample_val < 1 else None
+        self.seed = seed
+        self.read_ids = list()
+        self.read_lens = list()
+        self.read_count = 0
+        self.read_len_count = 0
+        self.read_len_mean = 0.0
+        self.read_len_m2 = 0.0
+        self.min_read_len = None
+        self.max_read_len = None
+        self.read_len_hist_counts = np.zeros(READ_LEN_HIST_BIN_COUNT, dtype=np.int64)
+        self.read_len_hist_bases = np.zeros(READ_LEN_HIST_BIN_COUNT, dtype=np.int64)
+        self.read_drop_counts = dict()
+
+    def add_read_lens(self, read_lens):
+        self.read_count += len(read_lens)
+
+        # A length of 0 means the length is unknown, e.g. reads taken from a read Id file
+        read_lens = np.asarray(read_lens, dtype=np.int64)
+        read_lens = read_lens[read_lens > 0]
+        if len(read_lens) == 0:
+            return
+
+        chunk_mean = float(np.mean(read_lens))
+        self.merge_read_len_moments(len(read_lens), chunk_mean, float(np.sum((read_lens - chunk_mean) ** 2)),
+                                    int(np.min(read_lens)), int(np.max(read_lens)))
+
+        hist_bins = np.minimum((np.log2(read_lens) * READ_LEN_HIST_BINS_PER_OCTAVE).astype(np.int64),
+                               READ_LEN_HIST_BIN_COUNT - 1)
+        self.read_len_hist_counts += np.bincount(hist_bins, minlength=READ_LEN_HIST_BIN_COUNT)
+        self.read_len_hist_bases += np.bincount(hist_bins, weights=read_lens, minlength=READ_LEN_HIST_BIN_COUNT).astype(np.int64)
+
+    def merge_read_len_moments(self, count, mean, m2, min_read_len, max_read_len):
+        # Chan et al. pairwise update, merging another count/mean/M2 into the running ones
+        total_count = self.read_len_count + count
+        delta = mean - self.read_len_mean
+        self.read_len_mean += delta * count / total_count
+        self.read_len_m2 += m2 + delta ** 2 * self.read_len_count * count / total_count
+        self.read_len_count = total_count
+
+        self.min_read_len = min_read_len if self.min_read_len is None else min(self.min_read_len, min_read_len)
+        self.max_read_len = max_read_len if self.max_read_len is None else max(self.max_read_len, max_read_len)
+
+    def add_read(self, read_id, read_len):
+        self.read_ids.append(read_id)
+        self.read_lens.append(read_len)
+
+        if len(self.read_ids) == READ_ID_CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if len(self.read_ids) == 0:
+            return
+
+        if self.hash_subsample_val is None:
+            self.add_read_lens(self.read_lens)
+        else:
+            read_id_records = create_read_id_records(self.read_ids, self.read_lens)
+            self.add_read_id_records(hash_subsample_read_id_records(read_id_records, self.hash_subsample_val, self.seed))
+
+        self.read_ids = list()
+        self.read_lens = list()
+
+    def add_read_id_records(self, read_id_records):
+        for i in range(0, len(read_id_records), READ_ID_CHUNK_SIZE):
+            self.add_read_lens(read_id_records['max_len'][i:i + READ_ID_CHUNK_SIZE])
+
+    def add_read_drop_reason(self, filter_reason):
+        self.read_drop_counts[filter_reason] = self.read_drop_counts.get(filter_reason, 0) + 1
+
+    def add_read_drop_counts(self, read_drop_counts):
+        self.read_drop_counts = merge_read_drop_counts([self.read_drop_counts, read_drop_counts])
+
+    def merge(self, other):
+        self.flush()
+        other.flush()
+
+        self.read_count += other.read_count
+        if other.read_len_count > 0:
+            self.merge_read_len_moments(other.read_len_count, other.read_len_mean, other.read_len_m2, other.min_read_len,
+                                        other.max_read_len)
+            self.read_len_hist_counts += other.read_len_hist_counts
+            self.read_len_hist_bases += other.read_len_hist_bases
+
+        self.add_read_drop_counts(other.read_drop_counts)
+
+    def get_read_len_sd(self):
+        return (self.read_len_m2 / self.read_len_count) ** 0.5 if self.read_len_count > 0 else None
+
+    def get_read_len_n50(self):
+        # Located in the histogram, then interpolated linearly within the bin holding the N50 read
+        if self.read_len_count == 0:
+            return None
+
+        rev_cum_bases = np.cumsum(self.read_len_hist_bases[::-1])
+        half_base_count = rev_cum_bases[-1] / 2
+        rev_bin = int(np.searchsorted(rev_cum_bases, half_base_count))
+        n50_bin = READ_LEN_HIST_BIN_COUNT - 1 - rev_bin
+
+        bin_min_len = 2 ** (n50_bin / READ_LEN_HIST_BINS_PER_OCTAVE)
+        bin_max_len = 2 ** ((n50_bin + 1) / READ_LEN_HIST_BINS_PER_OCTAVE)
+        bin_base_fraction = (half_base_count - (rev_cum_bases[rev_bin - 1] if rev_bin > 0 else 0)) / self.read_len_hist_bases[n50_bin]
+        n50 = round(bin_max_len - bin_base_fraction * (bin_max_len - bin_min_len))
+
+        return min(max(n50, self.min_read_len), self.max_read_len)
+
+    def to_dict(self):
+        read_stats = {'read_count': self.read_count, 'read_drop_counts': self.read_drop_counts}
+
+        if self.read_len_count > 0:
+            hist_bins = np.flatnonzero(self.read_len_hist_counts)
+            read_stats['read_len'] = {
+                'count': self.read_len_count,
+                'mean': round(self.read_len_mean, 2),
+                'sd': round(self.get_read_len_sd(), 2),
+                'min': self.min_read_len,
+                'max': self.max_read_len,
+                'n50': self.get_read_len_n50(),
+                'hist_bins_per_octave': READ_LEN_HIST_BINS_PER_OCTAVE,
+                'hist': [{'min_len': int(2 ** (b / READ_LEN_HIST_BINS_PER_OCTAVE)),
+                          'read_count': int(self.read_len_hist_counts[b]),
+                          'base_count': int(self.read_len_hist_bases[b])} for b in hist_bins]
+            }
+
+        return read_stats
+
+    def show(self):
+        if self.read_len_count == 0:
+            return
+
+        print(f'Mean read length (S.D.) = {round(self.read_len_mean, 2)} ({round(self.get_read_len_sd(), 2)})')
+        print(f'Max read length = {self.max_read_len}')
+        print(f'Min read length = {self.min_read_len}')
+        print(f'Read length N50 = {self.get_read_len_n50()}')
+
+class ReadIdRecordCollector:
+    """Accumulates read Ids/lengths into deduplicated record chunks, optionally hash-subsampled on the fly."""
+
+    def __init__(self, hash_subsample_val=None, seed=None):
+        self.hash_subsample_val = hash_subsample_val
+        self.seed = seed
+        self.read_id_record_chunks = list()
+        self.read_ids = list()
+        self.read_lens = list()
+
+    def add(self, read_id, read_len):
+        self.read_ids.append(read_id)
+        self.read_lens.append(read_len)
+
+        if len(self.read_ids) == READ_ID_CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        read_id_records = dedup_read_id_records(create_read_id_records(self.read_ids, self.read_lens))
+        self.read_ids = list()
+        self.read_lens = list()
+
+        if self.hash_subsample_val is None:
+            self.read_id_record_chunks.append(read_id_records)
+        elif self.hash_subsample_val < 1:
+            self.read_id_record_chunks.append(hash_subsample_read_id_records(read_id_records, self.hash_subsample_val,
+                                                                             self.seed))
+        else:
+            read_id_records = merge_read_id_records(self.read_id_record_chunks + [read_id_records])
+            self.read_id_record_chunks = [hash_subsample_read_id_records(read_id_records, self.hash_subsample_val,
+                                                                         self.seed)]
+
+    def get_read_id_records(self):
+        self.flush()
+        read_id_records = merge_read_id_records(self.read_id_record_chunks)
+
+        if self.hash_subsample_val is not None:
+            read_id_records = hash_subsample_read_id_records(read_id_records, self.hash_subsample_val, self.seed)
+
+        return read_id_records
+
+def get_aligned_read_len(aligned_read):
+    # Unmapped reads carry no CIGAR, so fall back to the stored query length
+    return aligned_read.infer_read_length() or aligned_read.query_length
+
+def is_aligned_read_counted(aligned_read):
+    # Each read has a single primary (or unmapped) record, so streamed lengths count every read once
+    return not (aligned_read.is_secondary or aligned_read.is_supplementary)
+
+def get_read_id_records_stats(read_id_records, read_drop_counts=None):
+    read_stats = ReadStatsAccumulator()
+    read_stats.add_read_id_records(read_id_records)
+    if read_drop_counts is not None:
+        read_stats.add_read_drop_counts(read_drop_counts)
+
+    return read_stats
+
+def merge_read_stats(read_stats_list, read_id_records, hash_subsample_val=None):
+    merged_read_stats = ReadStatsAccumulator()
+    for read_stats in read_stats_list:
+        merged_read_stats.merge(read_stats)
+
+    # A fixed-size hash subsample is only settled once every read is seen, so its lengths come from the kept reads
+    if hash_subsample_val is not None and hash_subsample_val >= 1:
+        merged_read_stats = get_read_id_records_stats(read_id_records, merged_read_stats.read_drop_counts)
+
+    # Reads selected through secondary/supplementary alignments only have no streamed length but are still counted
+    merged_read_stats.read_count = len(read_id_records)
+
+    return merged_read_stats
+
+def collect_read_id_records(aligned_reads, target_chrom=None, min_map_qual=0, is_primary_align_only=False,
+                            is_include_unmapped_read=False, owned_read_start=None, hash_subsample_val=None, seed=None):
+    read_id_collector = ReadIdRecordCollector(hash_subsample_val, seed)
+    read_stats = ReadStatsAccumulator(hash_subsample_val, seed)
+
+    for aligned_read in aligned_reads:
+        # Reads spanning a region boundary are owned by the first scan region they overlap
+        if owned_read_start is not None and aligned_read.reference_start < owned_read_start:
+            continue
+
+        filter_reason = get_aligned_read_filter_reason(aligned_read, target_chrom, min_map_qual, is_primary_align_only,
+                                                       is_include_unmapped_read)
+        if filter_reason is None:
+            read_len = get_aligned_read_len(aligned_read)
+            read_id_collector.add(aligned_read.query_name, read_len)
+            if is_aligned_read_counted(aligned_read):
+                read_stats.add_read(aligned_read.query_name, read_len)
+        else:
+            read_stats.add_read_drop_reason(filter_reason)
 
-    target_read_id_to_len_map = dict()
-    read_count = 0
+    read_stats.flush()
 
-    for aligned_read in src_align:
-        if aligned_read.is_unmapped:
-            if not is_include_unmapped_read:
-                continue
-        else:
-            if target_chrom is not None and aligned_read.reference_name != target_chrom:
-                continue
+    return read_id_collector.get_read_id_records(), read_stats
+
+def is_aligned_read_in_align_target(aligned_read, align_target):
+    if aligned_read.is_unmapped:
+        return align_target['type'] == 'unmapped'
+
+    if align_target['type'] == 'chrom':
+        return aligned_read.reference_name == align_target['target']
+
+    if align_target['type'] == 'regions':
+        contig_regions = align_target['regions'].get(aligned_read.reference_name)
+        if contig_regions is None:
+            return False
+
+        # Regions are merged and sorted, so only the first region ending after the read start can overlap it
+        region_starts, region_ends = contig_regions
+        i = bisect_right(region_ends, aligned_read.reference_start)
+        return i < len(region_starts) and region_starts[i] < aligned_read.reference_end
+
+    return False
 
-            if is_primary_align_only and (aligned_read.is_secondary or aligned_read.is_supplementary):
+def collect_multi_target_read_id_records(aligned_reads, align_targets, min_map_qual=0, is_primary_align_only=False,
+                                         owned_read_start=None, seed=None):
+    read_id_collectors = [ReadIdRecordCollector(align_target['hash_subsample_val'], seed) for align_target in align_targets]
+    read_stats_list = [ReadStatsAccumulator(align_target['hash_subsample_val'], seed) for align_target in align_targets]
+
+    for aligned_read in aligned_reads:
+        if owned_read_start is not None and aligned_read.reference_start < owned_read_start:
+            continue
+
+        filter_reason = get_aligned_read_filter_reason(aligned_read, None, min_map_qual, is_primary_align_only, True)
+        is_read_counted = is_aligned_read_counted(aligned_read)
+
+        read_len = None
+        for align_target, read_id_collector, read_stats in zip(align_targets, read_id_collectors, read_stats_list):
+            if not is_aligned_read_in_align_target(aligned_read, align_target):
                 continue
 
-            if aligned_read.mapping_quality < min_map_qual:
+            # Dropped reads are counted against every target they fall in
+            if filter_reason is not None:
+                read_stats.add_read_drop_reason(filter_reason)
                 continue
 
-        read_len = aligned_read.infer_read_length()
+            if read_len is None:
+                read_len = get_aligned_read_len(aligned_read)
+            read_id_collector.add(aligned_read.query_name, read_len)
+            if is_read_counted:
+                read_stats.add_read(aligned_read.query_name, read_len)
+
+    for read_stats in read_stats_list:
+        read_stats.flush()
+
+    return [read_id_collector.get_read_id_records() for read_id_collector in read_id_collectors], read_stats_list
 
-        if aligned_read.query_name in target_read_id_to_len_map:
-            if read_len > target_read_id_to_len_map[aligned_read.query_name]:
-                target_read_id_to_len_map[aligned_read.query_name] = read_len
+def get_align_scan_regions(src_align, target_chroms=None, is_include_unmapped_read=False, target_contig_regions=None):
+    # Contigs in target_contig_regions are only scanned over their (merged) regions, other target contigs in full
+    try:
+        contig_read_counts = {stat.contig: stat.total for stat in src_align.get_index_statistics()}
+    except (AttributeError, ValueError):
+        contig_read_counts = dict()
+
+    scan_regions = list()
+    for contig, contig_len in zip(src_align.references, src_align.lengths):
+        if target_chroms is not None and contig not in target_chroms:
+            continue
+
+        if contig_read_counts.get(contig, 1) == 0:
+            continue
+
+        if target_contig_regions is not None and contig in target_contig_regions:
+            contig_regions = zip(*target_contig_regions[contig])
         else:
-            target_read_id_to_len_map[aligned_read.query_name] = read_len
+            contig_regions = [(0, contig_len)]
+
+        # A fetch also returns reads starting before the region, which are owned by the previous scan region of the
+        # contig if they reach into it, i.e. if they start before its end
+        owned_read_start = 0
+        for region_start, region_end in contig_regions:
+            region_end = min(region_end, contig_len)
+            for split_start in range(max(region_start, 0), region_end, ALIGN_SCAN_REGION_SIZE):
+                split_end = min(split_start + ALIGN_SCAN_REGION_SIZE, region_end)
+                scan_regions.append((contig, split_start, split_end, owned_read_start))
+                owned_read_start = split_end
+
+    if is_include_unmapped_read:
+        scan_regions.append(('*', None, None, None))
+
+    return scan_regions
+
+def init_align_scan_worker(align_file_path):
+    global worker_src_align
+    worker_src_align = open_align_file(align_file_path)
+
+def fetch_scan_region(scan_region):
+    contig, region_start, region_end, _ = scan_region
+
+    if contig == '*':
+        return worker_src_align.fetch('*')
+
+    return worker_src_align.fetch(contig, region_start, region_end)
+
+def scan_align_region(scan_region, min_map_qual=0, is_primary_align_only=False, is_include_unmapped_read=False,
+                      hash_subsample_val=None, seed=None):
+    return collect_read_id_records(fetch_scan_region(scan_region), None, min_map_qual, is_primary_align_only,
+                                   is_include_unmapped_read, scan_region[3], hash_subsample_val, seed)
+
+def scan_align_region_for_targets(scan_region, align_targets, min_map_qual=0, is_primary_align_only=False, seed=None):
+    return collect_multi_target_read_id_records(fetch_scan_region(scan_region), align_targets, min_map_qual,
+                                                is_primary_align_only, scan_region[3], seed)
+
+def scan_align_file_parallel(align_file_path, scan_regions, min_map_qual=0, is_primary_align_only=False,
+                             is_include_unmapped_read=False, threads=1, hash_subsample_val=None, seed=None):
+    scan_region_func = partial(scan_align_region, min_map_qual=min_map_qual, is_primary_align_only=is_primary_align_only,
+                               is_include_unmapped_read=is_include_unmapped_read, hash_subsample_val=hash_subsample_val,
+                               seed=seed)
+
+    with ProcessPoolExecutor(max_workers=threads, initializer=init_align_scan_worker,
+                             initargs=(align_file_path,)) as executor:
+        region_scan_results = list(executor.map(scan_region_func, scan_regions))
+
+    target_read_id_records = merge_read_id_records([r[0] for r in region_scan_results])
+
+    if hash_subsample_val is not None:
+        target_read_id_records = hash_subsample_read_id_records(target_read_id_records, hash_subsample_val, seed)
+
+    return target_read_id_records, merge_read_stats([r[1] for r in region_scan_results], target_read_id_records,
+                                                      hash_subsample_val)
+
+def extract_read_ids_for_target_chrom(align_file_path, target_chrom=None, min_map_qual=0, is_primary_align_only=False,
+                                      is_include_unmapped_read=False, is_show_read_stats=True, threads=1,
+                                      hash_subsample_val=None, seed=None):
+    src_align = open_align_file(align_file_path)
+    if src_align is None:
+        return np.empty(0, dtype=READ_ID_RECORD_DTYPE), ReadStatsAccumulator()
+
+    if target_chrom is not None and target_chrom not in src_align.references:
+        print(f'Target chromosome \'{target_chrom}\' is not found in \'{align_file_path}\'.')
+        src_align.close()
+        return np.empty(0, dtype=READ_ID_RECORD_DTYPE), ReadStatsAccumulator()
+
+    if threads > 1 and src_align.has_index():
+        scan_regions = get_align_scan_regions(src_align, None if target_chrom is None else [target_chrom],
+                                              is_include_unmapped_read)
+        target_read_id_records, read_stats = scan_align_file_parallel(align_file_path, scan_regions, min_map_qual,
+                                                                      is_primary_align_only, is_include_unmapped_read,
+                                                                      threads, hash_subsample_val, seed)
+    else:
+        aligned_reads = iter_target_aligned_reads(src_align, target_chrom, is_include_unmapped_read)
+        target_read_id_records, read_stats = collect_read_id_records(aligned_reads, target_chrom, min_map_qual,
+                                                                     is_primary_align_only, is_include_unmapped_read,
+                                                                     None, hash_subsample_val, seed)
+        read_stats = merge_read_stats([read_stats], target_read_id_records, hash_subsample_val)
 
     if is_show_read_stats:
         if target_chrom is None:
-            print(f'Number of target reads: {len(target_read_id_to_len_map.keys())}')
+            print(f'Number of target reads: {len(target_read_id_records)}')
         else:
-            print(f'Number of target reads for \'{target_chrom}\': {len(target_read_id_to_len_map.keys())}')
+            print(f'Number of target reads for \'{target_chrom}\': {len(target_read_id_records)}')
 
-        #extract_read_lens = np.array(target_read_lens)
-        extract_read_lens = np.array(list(target_read_id_to_len_map.values()))
-        mean_read_len = round(np.mean(extract_read_lens), 2)
-        sd_read_len = round(np.std(extract_read_lens), 2)
-        max_read_len = np.max(extract_read_lens)
-        min_read_len = np.min(extract_read_lens)
+        read_stats.show()
 
-        print(f'Mean read length (S.D.) = {mean_read_len} ({sd_read_len})')
-        print(f'Max read length = {max_read_len}')
-        print(f'Min read length = {min_read_len}')
+    src_align.close()
+
+    return target_read_id_records, read_stats
+
+def extract_read_ids_for_align_targets(align_file_path, align_targets, min_map_qual=0, is_primary_align_only=False, threads=1,
+                                       seed=None):
+    # All chromosome/region/unmapped targets are collected in a single pass over the alignment file
+    src_align = open_align_file(align_file_path)
+    if src_align is None:
+        return [np.empty(0, dtype=READ_ID_RECORD_DTYPE) for _ in align_targets], [ReadStatsAccumulator() for _ in align_targets]
+
+    target_chroms = set()
+    target_contig_region_lists = dict()
+    for align_target in align_targets:
+        if align_target['type'] == 'chrom':
+            target_chroms.add(align_target['target'])
+        elif align_target['type'] == 'regions':
+            for contig, (region_starts, region_ends) in align_target['regions'].items():
+                target_contig_region_lists.setdefault(contig, list()).extend(zip(region_starts, region_ends))
+
+    # Contigs that are whole targets are scanned in full, the rest only over the merged regions of all region targets
+    target_contig_regions = {contig: merge_regions(regions) for contig, regions in target_contig_region_lists.items()
+                             if contig not in target_chroms}
+    target_chroms.update(target_contig_regions.keys())
+
+    for target_chrom in target_chroms - set(src_align.references):
+        print(f'Target chromosome \'{target_chrom}\' is not found in \'{align_file_path}\'.')
+
+    is_include_unmapped_read = any(align_target['type'] == 'unmapped' for align_target in align_targets)
+
+    if src_align.has_index():
+        scan_regions = get_align_scan_regions(src_align, target_chroms, is_include_unmapped_read, target_contig_regions)
+        scan_region_func = partial(scan_align_region_for_targets, align_targets=align_targets, min_map_qual=min_map_qual,
+                                   is_primary_align_only=is_primary_align_only, seed=seed)
+
+        if threads > 1:
+            with ProcessPoolExecutor(max_workers=threads, initializer=init_align_scan_worker,
+                                     initargs=(align_file_path,)) as executor:
+                region_scan_results = list(executor.map(scan_region_func, scan_regions))
+        else:
+            init_align_scan_worker(align_file_path)
+            region_scan_results = list(map(scan_region_func, scan_regions))
+    else:
+        region_scan_results = [collect_multi_target_read_id_records(src_align.fetch(until_eof=True), align_targets,
+                                                                    min_map_qual, is_primary_align_only, None, seed)]
 
     src_align.close()
 
-    target_read_ids = list(target_read_id_to_len_map.keys())
-    target_read_ids.sort()
+    target_read_id_records_list = list()
+    target_read_stats_list = list()
+    for i, align_target in enumerate(align_targets):
+        target_read_id_records = merge_read_id_records([r[0][i] for r in region_scan_results])
+
+        if align_target['hash_subsample_val'] is not None:
+            target_read_id_records = hash_subsample_read_id_records(target_read_id_records, align_target['hash_subsample_val'],
+                                                                    seed)
 
-    return target_read_ids
+        target_read_id_records_list.append(target_read_id_records)
+        target_read_stats_list.append(merge_read_stats([r[1][i] for r in region_scan_results], target_read_id_records,
+                                                       align_target['hash_subsample_val']))
+
+    return target_read_id_records_list, target_read_stats_list
 
 def get_output_file_name_prefix(src_file_path, target_chrom=None, user_label=None):
     src_file_name_prefix = str(PurePosixPath(src_file_path).stem)
@@ -108,58 +659,137 @@ def get_output_file_name_prefix(src_file_path, target_chrom=None, user_label=Non
 
     return src_file_name_prefix
 
-def generate_target_reads_file(target_read_ids, output_dir_path, output_reads_file_name_prefix):
+def generate_target_reads_file(target_read_id_records, output_dir_path, output_reads_file_name_prefix):
     target_reads_file_path = str(PurePosixPath(output_dir_path).joinpath(f'{output_reads_file_name_prefix}.txt'))
     
     with open(target_reads_file_path, 'w') as f:
-        for read_id in target_read_ids:
-            f.write(f'{read_id}\n')
+        for i in range(0, len(target_read_id_records), READ_ID_CHUNK_SIZE):
+            read_ids = uuids_to_read_ids(target_read_id_records['uuid'][i:i + READ_ID_CHUNK_SIZE])
+            f.write(''.join(f'{read_id}\n' for read_id in read_ids))
 
     return target_reads_file_path
 
+def generate_read_stats_file(read_stats, output_dir_path, output_reads_file_name_prefix):
+    read_stats_file_path = str(PurePosixPath(output_dir_path).joinpath(f'{output_reads_file_name_prefix}{READ_STATS_FILE_EXT}'))
+
+    with open(read_stats_file_path, 'w') as f:
+        json.dump(read_stats.to_dict(), f, indent=2)
+
+    return read_stats_file_path
+
 def parse_target_reads_file(target_reads_file_path):
+    read_id_record_chunks = list()
+
     with open(target_reads_file_path) as f:
-        target_read_ids = list(f.readlines())
+        while True:
+            read_ids = [read_id for read_id in map(str.strip, islice(f, READ_ID_CHUNK_SIZE)) if read_id != '']
+            if len(read_ids) == 0:
+                break
 
-    target_read_ids = list(set(map(str.rstrip, target_read_ids)))
-    target_read_ids.sort()
+            read_id_record_chunks.append(dedup_read_id_records(create_read_id_records(read_ids)))
 
-    return target_read_ids
+    return merge_read_id_records(read_id_record_chunks)
 
-def scan_dir_for_read_file_type(src_read_dir_paths):
-    is_fast5_exist = False
-    is_pod5_exist = False
+def scan_read_file_dir(dir_path):
+    # os.scandir() reports entry types without extra stat calls; only read files are stat'ed for their size/mtime
+    read_files = list()
+    sub_dir_paths = list()
 
-    for dir_path in src_read_dir_paths:
-        for child in Path(dir_path).iterdir():
-            if child.is_dir():
-                is_child_fast5_exist, is_child_pod5_exist = scan_dir_for_read_file_type([child])
-                if is_child_fast5_exist and is_child_pod5_exist:
-                    return is_child_fast5_exist, is_child_pod5_exist
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                sub_dir_paths.append(entry.path)
+                continue
 
-                if is_child_fast5_exist:
-                    is_fast5_exist = is_child_fast5_exist
+            read_file_ext = PurePosixPath(entry.name).suffix
+            if read_file_ext in READ_FILE_TYPES and entry.is_file():
+                entry_stat = entry.stat()
+                read_files.append({'path': entry.path, 'type': READ_FILE_TYPES[read_file_ext],
+                                   'size': entry_stat.st_size, 'mtime': entry_stat.st_mtime_ns})
 
-                if is_child_pod5_exist:
-                    is_pod5_exist = is_child_pod5_exist
-            else:
-                read_file_ext = PurePosixPath(child).suffix
+    return os.stat(dir_path).st_mtime_ns, read_files, sub_dir_paths
 
-                if read_file_ext == FAST5_FILE_EXT:
-                    is_fast5_exist = True
-                elif read_file_ext == POD5_FILE_EXT:
-                    is_pod5_exist = True
+def discover_read_files(src_read_dir_paths, threads=1):
+    # Walk the directory trees breadth-first, scanning sibling directories concurrently
+    dir_mtimes = dict()
+    read_files = list()
 
-            if is_fast5_exist and is_pod5_exist:
-                return is_fast5_exist, is_pod5_exist
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending_futures = {executor.submit(scan_read_file_dir, str(Path(d).resolve())): str(Path(d).resolve())
+                           for d in src_read_dir_paths}
 
-    return is_fast5_exist, is_pod5_exist
+        while len(pending_futures) > 0:
+            done_futures, _ = wait(pending_futures, return_when=FIRST_COMPLETED)
 
-def subsample_reads(target_read_ids, subsample_val, seed=None):
-    if seed is not None:
-        random.seed(seed)
+            for future in done_futures:
+                dir_path = pending_futures.pop(future)
+                dir_mtimes[dir_path], dir_read_files, sub_dir_paths = future.result()
+                read_files.extend(dir_read_files)
+
+                for sub_dir_path in sub_dir_paths:
+                    pending_futures[executor.submit(scan_read_file_dir, sub_dir_path)] = sub_dir_path
 
-    target_read_count = len(target_read_ids)
+    return {
+        'version': READ_FILE_MANIFEST_VERSION,
+        'src_read_dir_paths': sorted(str(Path(d).resolve()) for d in src_read_dir_paths),
+        'dir_mtimes': dict(sorted(dir_mtimes.items())),
+        'read_files': sorted(read_files, key=lambda f: f['path'])
+    }
+
+def is_read_file_manifest_current(read_file_manifest, src_read_dir_paths, threads=1):
+    if read_file_manifest.get('version') != READ_FILE_MANIFEST_VERSION or \
+       read_file_manifest['src_read_dir_paths'] != sorted(str(Path(d).resolve()) for d in src_read_dir_paths):
+        return False
+
+    # Adding, removing or renaming a file changes the mtime of its parent directory, while rewriting a file in place
+    # only changes its own size/mtime
+    def get_path_stat(path):
+        try:
+            path_stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+
+        return [path_stat.st_size, path_stat.st_mtime_ns]
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        dir_paths = list(read_file_manifest['dir_mtimes'].keys())
+        dir_mtimes = [None if path_stat is None else path_stat[1] for path_stat in executor.map(get_path_stat, dir_paths)]
+        if dir_mtimes != [read_file_manifest['dir_mtimes'][d] for d in dir_paths]:
+            return False
+
+        read_file_stats = get_manifest_read_file_stats(read_file_manifest)
+        return list(executor.map(get_path_stat, read_file_stats.keys())) == list(read_file_stats.values())
+
+def load_read_file_manifest(src_read_dir_paths, read_file_manifest_path=None, threads=1):
+    if read_file_manifest_path is not None and Path(read_file_manifest_path).is_file():
+        with open(read_file_manifest_path) as f:
+            read_file_manifest = json.load(f)
+
+        if is_read_file_manifest_current(read_file_manifest, src_read_dir_paths, threads):
+            print(f'Using read file manifest \'{read_file_manifest_path}\'')
+            return read_file_manifest
+
+        print(f'Read file manifest \'{read_file_manifest_path}\' is out of date. Rescanning source reads directories.')
+
+    read_file_manifest = discover_read_files(src_read_dir_paths, threads)
+
+    if read_file_manifest_path is not None:
+        with open(read_file_manifest_path, 'w') as f:
+            json.dump(read_file_manifest, f, indent=2)
+
+    return read_file_manifest
+
+def get_manifest_read_files(read_file_manifest, read_file_ext):
+    return [f['path'] for f in read_file_manifest['read_files'] if f['type'] == READ_FILE_TYPES[read_file_ext]]
+
+def get_manifest_read_file_sizes(read_file_manifest):
+    return {f['path']: f['size'] for f in read_file_manifest['read_files']}
+
+def get_manifest_read_file_stats(read_file_manifest):
+    return {f['path']: [f['size'], f['mtime']] for f in read_file_manifest['read_files']}
+
+def subsample_reads(target_read_id_records, subsample_val, seed=None):
+    target_read_count = len(target_read_id_records)
 
     if subsample_val < 1:
         subsample_size = round(target_read_count * subsample_val)
@@ -171,50 +801,555 @@ def subsample_reads(target_read_ids, subsample_val, seed=None):
     else:
         print(f'Subsampling {subsample_size} reads out of {target_read_count} reads (seed: {seed})')
 
-    return random.sample(target_read_ids, k=subsample_size)
+    # random.sample() picks positions from the population size alone, so sampling the UUID-sorted records selects the
+    # same reads for a given seed as sampling the sorted read Id strings did
+    if seed is not None:
+        random.seed(seed)
+    subsample_indices = np.sort(np.array(random.sample(range(target_read_count), k=subsample_size), dtype=np.int64))
+
+    return target_read_id_records[subsample_indices]
+
+def build_target_uuid_routes(target_read_id_records_list):
+    # A sorted union of all targets' UUIDs, each paired with the index of the target it belongs to. A read belonging to
+    # several targets occupies a contiguous run of entries.
+    target_uuids = np.concatenate([np.empty(0, dtype='S16')] + [r['uuid'] for r in target_read_id_records_list])
+    target_indices = np.repeat(np.arange(len(target_read_id_records_list), dtype=np.uint32),
+                               [len(r) for r in target_read_id_records_list])
+    uuid_order = np.argsort(target_uuids, kind='stable')
+
+    return target_uuids[uuid_order], target_indices[uuid_order]
+
+def partition_files_by_size(file_paths, partition_count, file_sizes):
+    # Greedily assign the largest remaining file to the lightest partition
+    partitions = [list() for _ in range(min(partition_count, len(file_paths)))]
+    partition_sizes = [0] * len(partitions)
+
+    for file_path in sorted(file_paths, key=lambda f: file_sizes[f], reverse=True):
+        i = partition_sizes.index(min(partition_sizes))
+        partitions[i].append(file_path)
+        partition_sizes[i] += file_sizes[file_path]
+
+    return partitions
+
+def report_export_throughput(read_file_type, read_file_count, scanned_read_count, exported_read_count, scanned_byte_count,
+                             elapsed_secs):
+    elapsed_secs = max(elapsed_secs, 1e-6)
+    print(f'Exported {exported_read_count} out of {scanned_read_count} reads from {read_file_count} {read_file_type} files '
+          f'in {elapsed_secs:.1f}s ({scanned_read_count / elapsed_secs:.0f} reads/s, '
+          f'{scanned_byte_count / elapsed_secs / 1e6:.1f} MB/s)')
+
+def get_pod5_batch_uuids(read_batch):
+    read_id_col = read_batch.read_id_column
+    if hasattr(read_id_col, 'storage'):
+        read_id_col = read_id_col.storage
+
+    uuids = np.frombuffer(read_id_col.buffers()[1], dtype='S16')
+
+    return uuids[read_id_col.offset:read_id_col.offset + len(read_id_col)]
+
+def init_read_export_worker(target_uuids, target_indices):
+    global worker_target_uuids, worker_target_indices
+    worker_target_uuids = target_uuids
+    worker_target_indices = target_indices
+
+def route_target_uuids(read_uuids):
+    route_starts = np.searchsorted(worker_target_uuids, read_uuids, side='left')
+    route_ends = np.searchsorted(worker_target_uuids, read_uuids, side='right')
+
+    for i in np.flatnonzero(route_ends > route_starts):
+        yield i, worker_target_indices[route_starts[i]:route_ends[i]]
+
+def extract_target_reads_from_pod5_files(pod5_file_batches, output_file_path_prefixes, pod5_file_sizes):
+    scanned_read_count = 0
+    exported_read_count = 0
+    scanned_byte_count = 0
+    writers = dict()
+
+    try:
+        for pod5_file_path, batch_indices in pod5_file_batches:
+            file_exported_read_count = 0
+
+            with pod5.Reader(pod5_file_path) as reader:
+                for read_batch in reader.read_batches(batch_selection=batch_indices):
+                    batch_uuids = get_pod5_batch_uuids(read_batch)
+                    scanned_read_count += len(batch_uuids)
+
+                    for row, target_indices in route_target_uuids(batch_uuids):
+                        read = read_batch.get_read(row).to_read()
+
+                        for target_index in target_indices:
+                            if target_index not in writers:
+                                writers[target_index] = pod5.Writer(f'{output_file_path_prefixes[target_index]}{POD5_FILE_EXT}')
+                            writers[target_index].add_read(read)
+                            file_exported_read_count += 1
+
+            exported_read_count += file_exported_read_count
+            scanned_byte_count += pod5_file_sizes[pod5_file_path]
+            print(f'{file_exported_read_count} reads exported from \'{pod5_file_path}\'', flush=True)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    return scanned_read_count, exported_read_count, scanned_byte_count
+
+def extract_target_reads_from_fast5_files(fast5_file_batches, output_file_path_prefixes, fast5_file_sizes):
+    scanned_read_count = 0
+    exported_read_count = 0
+    scanned_byte_count = 0
+    # Per target: [open output file, no. of reads in it, no. of output files so far]
+    outputs = dict()
+
+    try:
+        for fast5_file_path, _ in fast5_file_batches:
+            file_exported_read_count = 0
+
+            with h5py.File(fast5_file_path, 'r') as src:
+                # Multi-read FAST5 files keep each read in a 'read_<read Id>' group
+                read_group_names = [k for k in src.keys() if k.startswith('read_')]
+                scanned_read_count += len(read_group_names)
+
+                if len(read_group_names) == 0:
+                    print(f'\'{fast5_file_path}\' is not a multi-read FAST5 file. Skipped.', flush=True)
+
+                for i, target_indices in route_target_uuids(read_ids_to_uuids([k[5:] for k in read_group_names])):
+                    for target_index in target_indices:
+                        output = outputs.setdefault(target_index, [None, 0, 0])
+
+                        if output[0] is None or output[1] == FAST5_READS_PER_FILE:
+                            if output[0] is not None:
+                                output[0].close()
+
+                            output[0] = h5py.File(f'{output_file_path_prefixes[target_index]}.{output[2]}{FAST5_FILE_EXT}', 'w')
+                            output[0].attrs.update(src.attrs)
+                            output[1] = 0
+                            output[2] += 1
+
+                        # Copies the raw (still compressed) datasets of the read group without decoding them
+                        src.copy(src[read_group_names[i]], output[0], name=read_group_names[i])
+                        output[1] += 1
+                        file_exported_read_count += 1
+
+            exported_read_count += file_exported_read_count
+            scanned_byte_count += fast5_file_sizes[fast5_file_path]
+            print(f'{file_exported_read_count} reads exported from \'{fast5_file_path}\'', flush=True)
+    finally:
+        for output in outputs.values():
+            if output[0] is not None:
+                output[0].close()
+
+    return scanned_read_count, exported_read_count, scanned_byte_count
+
+def allocate_export_workers(read_file_byte_counts, threads):
+    # Every read file type gets a worker, the rest of the budget is shared out in proportion to the bytes to scan
+    read_file_exts = [e for e, c in read_file_byte_counts.items() if c is not None]
+    worker_counts = {e: 1 for e in read_file_exts}
+    spare_worker_count = threads - len(read_file_exts)
+    total_byte_count = sum(read_file_byte_counts[e] for e in read_file_exts)
+
+    if spare_worker_count > 0 and total_byte_count > 0:
+        worker_shares = {e: spare_worker_count * read_file_byte_counts[e] / total_byte_count for e in read_file_exts}
+        for e in read_file_exts:
+            worker_counts[e] += int(worker_shares[e])
+
+        # Largest remainder first for the workers left over after rounding down
+        for e in sorted(read_file_exts, key=lambda e: worker_shares[e] - int(worker_shares[e]), reverse=True):
+            if sum(worker_counts.values()) >= threads:
+                break
+            worker_counts[e] += 1
+
+    return worker_counts
+
+def extract_target_reads_from_read_files(read_file_exts, read_file_manifest, output_dir_path, target_read_id_records_list,
+                                         output_reads_file_name_prefixes, threads=1, read_file_index=None):
+    # Reads of every target are routed to the matching outputs in a single pass over the read files
+    target_uuids, target_indices = build_target_uuid_routes(target_read_id_records_list)
+    read_file_sizes = get_manifest_read_file_sizes(read_file_manifest)
+
+    # Without an index every batch of every read file has to be scanned
+    read_file_to_batches_by_ext = dict()
+    for read_file_ext in read_file_exts:
+        if read_file_index is None:
+            read_file_to_batches_by_ext[read_file_ext] = {f: None for f in get_manifest_read_files(read_file_manifest, read_file_ext)}
+        else:
+            read_file_to_batches_by_ext[read_file_ext] = locate_target_reads(read_file_index, target_uuids, read_file_ext)
+
+    # Read file types are exported concurrently, sharing the worker budget
+    worker_counts = allocate_export_workers({e: sum(read_file_sizes[f] for f in b) if len(b) > 0 else None
+                                             for e, b in read_file_to_batches_by_ext.items()}, threads)
+
+    export_jobs = list()
+    for read_file_ext, read_file_to_batches in read_file_to_batches_by_ext.items():
+        read_file_partitions = [[(f, read_file_to_batches[f]) for f in read_file_partition]
+                                for read_file_partition in partition_files_by_size(list(read_file_to_batches.keys()),
+                                                                                   worker_counts.get(read_file_ext, 1),
+                                                                                   read_file_sizes)]
+
+        # One output shard per worker and target, keeping the original output file name when there is a single worker
+        if len(read_file_partitions) == 1:
+            output_file_path_prefixes = [[str(PurePosixPath(output_dir_path).joinpath(prefix))
+                                          for prefix in output_reads_file_name_prefixes]]
+        else:
+            output_file_path_prefixes = [[str(PurePosixPath(output_dir_path).joinpath(f'{prefix}.{i}'))
+                                          for prefix in output_reads_file_name_prefixes]
+                                         for i in range(len(read_file_partitions))]
 
-def extract_target_reads_from_fast5_dir(fast5_dir_paths, output_dir_path, target_reads_file_path, output_reads_file_name_prefix, threads=1):
-    for dir_path in fast5_dir_paths:
-        if len(fast5_dir_paths) == 1:
-            target_output_dir_path = output_dir_path
+        if read_file_ext == POD5_FILE_EXT:
+            extract_target_reads_func = extract_target_reads_from_pod5_files
+        else:
+            extract_target_reads_func = extract_target_reads_from_fast5_files
+
+        export_jobs.extend((read_file_ext, extract_target_reads_func, p, o)
+                           for p, o in zip(read_file_partitions, output_file_path_prefixes))
+
+    # Per read file type: [no. of read files, scanned reads, exported reads, scanned bytes, elapsed seconds]
+    export_stats = {e: [len(b), 0, 0, 0, 0.0] for e, b in read_file_to_batches_by_ext.items()}
+    start_time = time.monotonic()
+
+    with ProcessPoolExecutor(max_workers=max(min(threads, len(export_jobs)), 1), initializer=init_read_export_worker,
+                             initargs=(target_uuids, target_indices)) as executor:
+        future_to_ext = {executor.submit(func, read_file_partition, output_file_path_prefix,
+                                         {f: read_file_sizes[f] for f, _ in read_file_partition}): read_file_ext
+                         for read_file_ext, func, read_file_partition, output_file_path_prefix in export_jobs}
+
+        for completed_job_count, future in enumerate(as_completed(future_to_ext), start=1):
+            read_file_ext = future_to_ext[future]
+            try:
+                shard_counts = future.result()
+            except Exception as e:
+                sys.exit(f'{READ_FILE_TYPES[read_file_ext].upper()} reads extraction failed: {e}')
+
+            for i, shard_count in enumerate(shard_counts, start=1):
+                export_stats[read_file_ext][i] += shard_count
+            export_stats[read_file_ext][4] = time.monotonic() - start_time
+
+            if len(export_jobs) > 1:
+                print(f'Export progress: {completed_job_count}/{len(export_jobs)} shards done, '
+                      + ', '.join(f'{READ_FILE_TYPES[e].upper()} {s[2]} reads' for e, s in export_stats.items()), flush=True)
+
+    for read_file_ext, export_stat in export_stats.items():
+        report_export_throughput(READ_FILE_TYPES[read_file_ext].upper(), *export_stat)
+
+    if len(export_stats) > 1:
+        report_export_throughput('FAST5/POD5', *[sum(s[i] for s in export_stats.values()) for i in range(4)],
+                                 time.monotonic() - start_time)
+
+def index_read_file(read_file_path):
+    uuid_chunks = list()
+    batch_index_chunks = list()
+    batch_row_chunks = list()
+
+    if PurePosixPath(read_file_path).suffix == POD5_FILE_EXT:
+        with pod5.Reader(read_file_path) as reader:
+            for batch_index, read_batch in enumerate(reader.read_batches()):
+                uuids = get_pod5_batch_uuids(read_batch).copy()
+                uuid_chunks.append(uuids)
+                batch_index_chunks.append(np.full(len(uuids), batch_index, dtype=np.uint32))
+                batch_row_chunks.append(np.arange(len(uuids), dtype=np.uint32))
+    else:
+        # Multi-read FAST5 files keep each read in a 'read_<read Id>' group
+        with h5py.File(read_file_path, 'r') as f:
+            read_ids = [k[5:] for k in f.keys() if k.startswith('read_')]
+
+        uuid_chunks.append(read_ids_to_uuids(read_ids))
+        batch_index_chunks.append(np.zeros(len(read_ids), dtype=np.uint32))
+        batch_row_chunks.append(np.arange(len(read_ids), dtype=np.uint32))
+
+    if len(uuid_chunks) == 0:
+        return np.empty(0, dtype='S16'), np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.uint32)
+
+    return np.concatenate(uuid_chunks), np.concatenate(batch_index_chunks), np.concatenate(batch_row_chunks)
+
+def build_read_file_index(read_file_manifest, index_dir_path, threads=1):
+    # The manifest directory mtimes are taken before scanning so that files added mid-build invalidate the index
+    read_file_paths = get_manifest_read_files(read_file_manifest, POD5_FILE_EXT) + \
+                      get_manifest_read_files(read_file_manifest, FAST5_FILE_EXT)
+
+    with ProcessPoolExecutor(max_workers=threads) as executor:
+        read_file_entries = list(executor.map(index_read_file, read_file_paths))
+
+    uuids = np.concatenate([np.empty(0, dtype='S16')] + [entry[0] for entry in read_file_entries])
+    read_locations = np.empty(len(uuids), dtype=READ_LOCATION_DTYPE)
+    read_locations['file_index'] = np.repeat(np.arange(len(read_file_entries), dtype=np.uint32),
+                                             [len(entry[0]) for entry in read_file_entries])
+    read_locations['batch_index'] = np.concatenate([np.empty(0, dtype=np.uint32)] + [entry[1] for entry in read_file_entries])
+    read_locations['batch_row'] = np.concatenate([np.empty(0, dtype=np.uint32)] + [entry[2] for entry in read_file_entries])
+
+    uuid_order = np.argsort(uuids, kind='stable')
+
+    create_non_exist_dir(index_dir_path)
+    np.save(Path(index_dir_path).joinpath(READ_FILE_INDEX_UUIDS_FILE_NAME), uuids[uuid_order])
+    np.save(Path(index_dir_path).joinpath(READ_FILE_INDEX_LOCATIONS_FILE_NAME), read_locations[uuid_order])
+
+    with open(Path(index_dir_path).joinpath(READ_FILE_INDEX_META_FILE_NAME), 'w') as f:
+        json.dump({
+            'version': READ_FILE_INDEX_VERSION,
+            'src_read_dir_paths': read_file_manifest['src_read_dir_paths'],
+            'dir_mtimes': read_file_manifest['dir_mtimes'],
+            'read_file_stats': get_manifest_read_file_stats(read_file_manifest),
+            'read_files': read_file_paths
+        }, f, indent=2)
+
+    print(f'Indexed {len(uuids)} reads in {len(read_file_paths)} read files to \'{index_dir_path}\'')
+
+def load_read_file_index(index_dir_path, read_file_manifest, threads=1):
+    index_meta_file_path = Path(index_dir_path).joinpath(READ_FILE_INDEX_META_FILE_NAME)
+    if not index_meta_file_path.is_file():
+        print(f'Read file index \'{index_dir_path}\' does not exist. Scanning all read files instead.')
+        return None
+
+    with open(index_meta_file_path) as f:
+        index_meta = json.load(f)
+
+    if index_meta['src_read_dir_paths'] != read_file_manifest['src_read_dir_paths']:
+        print(f'Read file index \'{index_dir_path}\' does not match the source reads directories. Scanning all read files instead.')
+        return None
+
+    # The manifest is current by now, so a file added, removed or rewritten in place shows up as a changed stat
+    if index_meta.get('version') != READ_FILE_INDEX_VERSION or \
+       index_meta['dir_mtimes'] != read_file_manifest['dir_mtimes'] or \
+       index_meta['read_file_stats'] != get_manifest_read_file_stats(read_file_manifest):
+        print(f'Read file index \'{index_dir_path}\' is out of date. Rebuilding it.')
+        build_read_file_index(read_file_manifest, index_dir_path, threads)
+
+        with open(index_meta_file_path) as f:
+            index_meta = json.load(f)
+
+    return {
+        'read_files': index_meta['read_files'],
+        'read_ids': np.load(Path(index_dir_path).joinpath(READ_FILE_INDEX_UUIDS_FILE_NAME), mmap_mode='r'),
+        'read_locations': np.load(Path(index_dir_path).joinpath(READ_FILE_INDEX_LOCATIONS_FILE_NAME), mmap_mode='r')
+    }
+
+def locate_target_reads(read_file_index, target_uuids, read_file_ext):
+    # The same read may be stored in more than one file, so take every index entry of each target UUID
+    index_uuids = read_file_index['read_ids']
+    range_starts = np.searchsorted(index_uuids, target_uuids, side='left')
+    range_counts = np.searchsorted(index_uuids, target_uuids, side='right') - range_starts
+    range_offsets = np.arange(range_counts.sum()) - np.repeat(np.cumsum(range_counts) - range_counts, range_counts)
+    read_locations = read_file_index['read_locations'][np.repeat(range_starts, range_counts) + range_offsets]
+
+    read_file_to_batches = dict()
+    for file_index in np.unique(read_locations['file_index']):
+        read_file_path = read_file_index['read_files'][file_index]
+        if PurePosixPath(read_file_path).suffix != read_file_ext:
+            continue
+
+        file_read_locations = read_locations[read_locations['file_index'] == file_index]
+        read_file_to_batches[read_file_path] = np.unique(file_read_locations['batch_index']).tolist()
+
+    return read_file_to_batches
+
+def merge_regions(regions):
+    region_starts = list()
+    region_ends = list()
+
+    for region_start, region_end in sorted(regions):
+        if len(region_ends) > 0 and region_start <= region_ends[-1]:
+            region_ends[-1] = max(region_ends[-1], region_end)
         else:
-            target_output_dir_path = str(PurePosixPath(output_dir_path).joinpath(PurePosixPath(dir_path).stem))
-            create_non_exist_dir(target_output_dir_path)
+            region_starts.append(region_start)
+            region_ends.append(region_end)
+
+    return region_starts, region_ends
+
+def parse_bed_regions(bed_file_path):
+    contig_regions = dict()
+
+    with open(bed_file_path) as f:
+        for line in f:
+            if line.startswith(('#', 'track', 'browser')) or line.strip() == '':
+                continue
+
+            cols = line.split('\t')
+            contig_regions.setdefault(cols[0], list()).append((int(cols[1]), int(cols[2])))
+
+    # Merge overlapping regions so that a single binary search finds the only candidate region for a read
+    return {contig: merge_regions(regions) for contig, regions in contig_regions.items()}
+
+def parse_target_manifest_file(manifest_file_path):
+    if not Path(manifest_file_path).is_file():
+        sys.exit(f'Target manifest file \'{manifest_file_path}\' does not exist.')
+
+    manifest_targets = list()
+    target_labels = set()
+
+    with open(manifest_file_path) as f:
+        for line_num, line in enumerate(f, start=1):
+            if line.startswith('#') or line.strip() == '':
+                continue
+
+            cols = [col.strip() for col in line.rstrip('\n').split('\t')]
+            cols += [''] * (4 - len(cols))
+            target_label, target_type, target, subsample_val = cols[:4]
+
+            if not is_user_label_valid(target_label) or target_label in target_labels:
+                sys.exit(f'Line {line_num} of \'{manifest_file_path}\': \'{target_label}\' is not a valid or unique target label.')
+            target_labels.add(target_label)
+
+            if target_type == 'chrom':
+                if not is_input_chrom_valid(target):
+                    sys.exit(f'Line {line_num} of \'{manifest_file_path}\': \'{target}\' is not a valid chromosome label.')
+            elif target_type in ['regions', 'read_ids']:
+                if not Path(target).is_file():
+                    sys.exit(f'Line {line_num} of \'{manifest_file_path}\': \'{target}\' does not exist.')
+            elif target_type != 'unmapped':
+                sys.exit(f'Line {line_num} of \'{manifest_file_path}\': \'{target_type}\' is not a valid target type '
+                         '(chrom, regions, unmapped or read_ids).')
+
+            if subsample_val == '':
+                subsample_val = None
+            else:
+                subsample_val = parse_subsample_val(subsample_val)
+                if subsample_val is None:
+                    sys.exit(f'Line {line_num} of \'{manifest_file_path}\': subsampling value must be either a fraction '
+                             'between 0 and 1 (exclusive) or a positive integer.')
+
+            manifest_targets.append({
+                'label': target_label,
+                'type': target_type,
+                'target': target,
+                'regions': parse_bed_regions(target) if target_type == 'regions' else None,
+                'subsample_val': subsample_val
+            })
+
+    if len(manifest_targets) == 0:
+        sys.exit(f'Target manifest file \'{manifest_file_path}\' is empty.')
+
+    return manifest_targets
+
+def extract_manifest_target_reads(args, manifest_targets, read_file_manifest, threads=1, read_file_index=None):
+    for manifest_target in manifest_targets:
+        manifest_target['hash_subsample_val'] = manifest_target['subsample_val'] if args.is_hash_subsample else None
+
+    align_targets = [t for t in manifest_targets if t['type'] != 'read_ids']
+    if len(align_targets) > 0:
+        if args.bam_file_path is None:
+            sys.exit('A BAM file is required for chrom, regions and unmapped targets.')
+
+        align_target_read_id_records_list, align_target_read_stats_list = \
+            extract_read_ids_for_align_targets(args.bam_file_path, align_targets, is_primary_align_only=args.is_primary_align_only,
+                                               threads=threads, seed=args.seed)
+
+        for align_target, target_read_id_records, read_stats in zip(align_targets, align_target_read_id_records_list,
+                                                                    align_target_read_stats_list):
+            align_target['read_id_records'] = target_read_id_records
+            align_target['read_stats'] = read_stats
+            align_target['src_file_path'] = args.bam_file_path
+
+    for manifest_target in manifest_targets:
+        if manifest_target['type'] == 'read_ids':
+            manifest_target['read_id_records'] = parse_target_reads_file(manifest_target['target'])
+            manifest_target['read_stats'] = get_read_id_records_stats(manifest_target['read_id_records'])
+            manifest_target['src_file_path'] = manifest_target['target']
+
+        print(f'Number of target reads for \'{manifest_target["label"]}\': {len(manifest_target["read_id_records"])}')
+
+    if args.dry_run:
+        for manifest_target in manifest_targets:
+            print(f'Read stats for \'{manifest_target["label"]}\':')
+            print(json.dumps(manifest_target['read_stats'].to_dict(), indent=2))
+
+        print('No action performed in dry-run mode.')
+        return
+
+    for manifest_target in manifest_targets:
+        output_reads_file_name_prefix = get_output_file_name_prefix(manifest_target['src_file_path'], None, manifest_target['label'])
+
+        if manifest_target['subsample_val'] is not None:
+            # Alignment targets are already hash-subsampled, along with their stats, while scanning the BAM file
+            is_subsampled_in_scan = manifest_target['hash_subsample_val'] is not None and manifest_target['type'] != 'read_ids'
+
+            if manifest_target['hash_subsample_val'] is None:
+                manifest_target['read_id_records'] = subsample_reads(manifest_target['read_id_records'],
+                                                                     manifest_target['subsample_val'], args.seed)
+            elif not is_subsampled_in_scan:
+                manifest_target['read_id_records'] = hash_subsample_read_id_records(manifest_target['read_id_records'],
+                                                                                    manifest_target['subsample_val'], args.seed)
+
+            # Length stats describe the exported subsample, while drop counts still come from the full scan
+            if not is_subsampled_in_scan:
+                manifest_target['read_stats'] = get_read_id_records_stats(manifest_target['read_id_records'],
+                                                                          manifest_target['read_stats'].read_drop_counts)
 
-        cmd_str = f'python {ONT_FAST5_SUBSET_TOOL_PATH} -r -i {fast5_dir_paths} -s {target_output_dir_path} -l {target_reads_file_path} \
-                    -f {output_reads_file_name_prefix}. -t {threads}'
-        cmd_args = shlex.split(cmd_str)
-        subprocess.run(cmd_args)
+            output_reads_file_name_prefix = f'{output_reads_file_name_prefix}.subsample_{len(manifest_target["read_id_records"])}'
 
-def extract_target_reads_from_pod5_dir(pod5_dir_paths, output_dir_path, target_reads_file_path, output_reads_file_name_prefix, threads=1):
-    pod5_dir_path_str = ' '.join(pod5_dir_paths)
-    output_pod5_file_path = str(PurePosixPath(output_dir_path).joinpath(f'{output_reads_file_name_prefix}.pod5'))
-    cmd_str = f'pod5 filter -r {pod5_dir_path_str} -i {target_reads_file_path} -o {output_pod5_file_path} --missing-ok -t {threads}'
-    cmd_args = shlex.split(cmd_str)
-    subprocess.run(cmd_args)
+        manifest_target['output_reads_file_name_prefix'] = output_reads_file_name_prefix
+        manifest_target['read_id_file_path'] = generate_target_reads_file(manifest_target['read_id_records'], args.output_dir_path,
+                                                                          output_reads_file_name_prefix)
+
+        generate_read_stats_file(manifest_target['read_stats'], args.output_dir_path, output_reads_file_name_prefix)
+
+    print('Exporting reads...')
+
+    read_file_exts = [e for e in [FAST5_FILE_EXT, POD5_FILE_EXT] if len(get_manifest_read_files(read_file_manifest, e)) > 0]
+    extract_target_reads_from_read_files(read_file_exts, read_file_manifest, args.output_dir_path,
+                                         [t['read_id_records'] for t in manifest_targets],
+                                         [t['output_reads_file_name_prefix'] for t in manifest_targets], threads, read_file_index)
+
+    print(f'Extracted reads exported to directory \'{args.output_dir_path}\'')
+
+    for manifest_target in manifest_targets:
+        print(f'The read Id list for \'{manifest_target["label"]}\' is exported to {manifest_target["read_id_file_path"]}')
+
+def build_index_main(argv):
+    parser = ArgumentParser('Read Id index builder for ONT long reads in FAST5/POD5 format')
+    parser.add_argument('-i', '--input', required=True, action='store', dest='src_read_dir_paths', nargs='+',
+                        help='Source long reads FAST5/POD5 directory paths')
+    parser.add_argument('-x', '--index', required=True, action='store', dest='read_file_index_path',
+                        help='Output read file index directory path')
+    parser.add_argument('-f', '--file-manifest', required=False, action='store', dest='read_file_manifest_path',
+                        help='Read file manifest path, reused if the source reads directories are unchanged')
+    default_cpu_count = cpu_count()
+    parser.add_argument('-T', '--threads', action='store', dest='threads', type=int, default=default_cpu_count,
+                        help=f'Maximum no. of threads (default: {default_cpu_count})')
+    args = parser.parse_args(argv)
+
+    for dir_path in args.src_read_dir_paths:
+        if not Path(dir_path).is_dir():
+            sys.exit(f'Source reads directory \'{dir_path}\' does not exist.')
+
+    proc_threads = max(args.threads, 1)
+    read_file_manifest = load_read_file_manifest(args.src_read_dir_paths, args.read_file_manifest_path, proc_threads)
+    build_read_file_index(read_file_manifest, args.read_file_index_path, proc_threads)
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'index':
+        build_index_main(sys.argv[2:])
+        return
+
     parser = ArgumentParser('Extraction tool for ONT long reads in FAST5/POD5 format')
     parser.add_argument('-i', '--input', required=True, action='store', dest='src_read_dir_paths', nargs='+',
                        help=f'Source long reads FAST5/POD5 directory paths')
     parser.add_argument('-o', '--output', required=True, action='store', dest='output_dir_path',
                         help='Output directory path for extracted long reads')
-    group = parser.add_mutually_exclusive_group(required=True)
+    group = parser.add_mutually_exclusive_group(required=False)
     group.add_argument('-b', '--bam', action='store', dest='bam_file_path', help='BAM file path')
     group.add_argument('-t', '--target', action='store', dest='read_id_file_path', help='Target read Ids file path')
     #parser.add_argument('-c', '--cram', required=False, help=f'CRAM file path (default: {DEFAULT_CRAM_FILE_PATH})',
     #                    default=DEFAULT_CRAM_FILE_PATH)
+    parser.add_argument('-M', '--manifest', required=False, action='store', dest='manifest_file_path',
+                        help='Target manifest file path (tab-delimited: label, type [chrom|regions|unmapped|read_ids], '
+                             'target [chromosome|BED file|read Id file], subsample) to extract many targets in one pass')
     parser.add_argument('-m', '--chrom', required=False, action='store', dest='chrom', help='Target chromosome (for BAM file only)')
     parser.add_argument('-p', '--primary', required=False, action='store_true', dest='is_primary_align_only',
                         help='Includes primary alignment only  (for BAM file only)', default=False)
     parser.add_argument('-u', '--unmapped', required=False, action='store_true', dest='is_include_unmapped_read',
-                        help='Includes unmapped reads (overrides target chromosome, for BAM file only)', default=False)
+                        help='Includes unmapped reads (for BAM file only). With a target chromosome and an indexed BAM file, '
+                             'only unmapped reads placed on the target chromosome or in the unplaced tail are included',
+                        default=False)
     parser.add_argument('-l', '--label', required=False, action='store', dest='user_label',
                         help='User-defined label to be appended to the output reads file name')
     parser.add_argument('-s', '--subsample', required=False, action='store', dest='subsample_val',
                         help='Randomly subsample reads based on fraction (between 0 and 1) or absolute number (+ve integer > 1)')
     parser.add_argument('-S', '--seed', required=False, type=int, action='store', dest='seed',
                         help='Seed value for random subsampling')
+    parser.add_argument('-H', '--hash-subsample', required=False, action='store_true', dest='is_hash_subsample',
+                        help='Subsample reads by read Id hash, applied while scanning the BAM file. The same reads are '
+                             'selected regardless of input order, no. of threads or BAM/target read Id file input', default=False)
+    parser.add_argument('-x', '--index', required=False, action='store', dest='read_file_index_path',
+                        help='Read file index directory path (built by the \'index\' subcommand) to locate target reads')
+    parser.add_argument('-f', '--file-manifest', required=False, action='store', dest='read_file_manifest_path',
+                        help='Read file manifest path, reused if the source reads directories are unchanged')
     parser.add_argument('-d', '--dry-run', required=False, action='store_true', dest='dry_run',
                         help='Dry-run mode. Show reads statistics only')
     default_cpu_count = cpu_count()
@@ -235,23 +1370,37 @@ def main():
     if args.subsample_val is None:
         subsample_val = 1
     else:
-        if is_subsample_val_valid(args.subsample_val):
-            if is_subsample_val_float(args.subsample_val):
-                subsample_val = float(args.subsample_val)
-            else:
-                subsample_val = int(args.subsample_val)
-        else:
+        subsample_val = parse_subsample_val(args.subsample_val)
+        if subsample_val is None:
             sys.exit('Subsampling value must be either a fraction between 0 and 1 (exclusive) or a positive integer.')
 
-    is_fast5_exist, is_pod5_exist = scan_dir_for_read_file_type(args.src_read_dir_paths)
-    if not is_fast5_exist and not is_pod5_exist:
-        sys.exit(f'No reads files are found in \'{args.src_read_dir_paths}\'.')
+    if args.manifest_file_path is not None:
+        if args.read_id_file_path is not None:
+            sys.exit('Target manifest and target read Id file cannot be used together.')
+
+        # The manifest gives each target its own chromosome/regions, label and subsample setting
+        manifest_conflict_opts = [opt for opt, is_set in [('-m/--chrom', args.chrom is not None),
+                                                          ('-l/--label', args.user_label is not None),
+                                                          ('-s/--subsample', args.subsample_val is not None),
+                                                          ('-u/--unmapped', args.is_include_unmapped_read)] if is_set]
+        if len(manifest_conflict_opts) > 0:
+            sys.exit(f'Target manifest cannot be used together with {", ".join(manifest_conflict_opts)}.')
+
+        manifest_targets = parse_target_manifest_file(args.manifest_file_path)
+    elif args.bam_file_path is None and args.read_id_file_path is None:
+        sys.exit('No BAM file, target read Id file or target manifest is provided.')
 
     if args.threads < 1:
         proc_threads = default_cpu_count
     else:
         proc_threads = args.threads
 
+    read_file_manifest = load_read_file_manifest(args.src_read_dir_paths, args.read_file_manifest_path, proc_threads)
+    is_fast5_exist = len(get_manifest_read_files(read_file_manifest, FAST5_FILE_EXT)) > 0
+    is_pod5_exist = len(get_manifest_read_files(read_file_manifest, POD5_FILE_EXT)) > 0
+    if not is_fast5_exist and not is_pod5_exist:
+        sys.exit(f'No reads files are found in \'{args.src_read_dir_paths}\'.')
+
     if not args.dry_run:
         '''
         if args.chrom is None:
@@ -264,19 +1413,40 @@ def main():
 
         create_non_exist_dir(args.output_dir_path)
 
+    if args.read_file_index_path is None or args.dry_run:
+        read_file_index = None
+    else:
+        read_file_index = load_read_file_index(args.read_file_index_path, read_file_manifest, proc_threads)
+
+    if args.manifest_file_path is not None:
+        extract_manifest_target_reads(args, manifest_targets, read_file_manifest, proc_threads, read_file_index)
+        return
+
+    is_hash_subsample = args.is_hash_subsample and subsample_val != 1
+
     if args.bam_file_path is not None:
-        target_read_ids = extract_read_ids_for_target_chrom(args.bam_file_path, target_chrom=args.chrom,
-                                                            is_primary_align_only=args.is_primary_align_only,
-                                                            is_include_unmapped_read=args.is_include_unmapped_read)
+        target_read_id_records, read_stats = extract_read_ids_for_target_chrom(args.bam_file_path, target_chrom=args.chrom,
+                                                                               is_primary_align_only=args.is_primary_align_only,
+                                                                               is_include_unmapped_read=args.is_include_unmapped_read,
+                                                                               threads=proc_threads,
+                                                                               hash_subsample_val=subsample_val if is_hash_subsample else None,
+                                                                               seed=args.seed)
         if not args.dry_run:
             output_reads_file_name_prefix = get_output_file_name_prefix(args.bam_file_path, args.chrom, args.user_label)
-            #target_reads_file_path = generate_target_reads_file(target_read_ids, output_dir_path, output_reads_file_name_prefix)
-            target_reads_file_path = generate_target_reads_file(target_read_ids, args.output_dir_path, output_reads_file_name_prefix)
+
+            # Hash-based subsampling is applied during the BAM scan, so the full target read list is never materialised
+            if is_hash_subsample:
+                target_reads_file_path = None
+            else:
+                #target_reads_file_path = generate_target_reads_file(target_read_id_records, output_dir_path, output_reads_file_name_prefix)
+                target_reads_file_path = generate_target_reads_file(target_read_id_records, args.output_dir_path, output_reads_file_name_prefix)
     elif args.read_id_file_path is not None:
-        target_read_ids = parse_target_reads_file(args.read_id_file_path)
-        target_read_count = len(target_read_ids)
+        target_read_id_records = parse_target_reads_file(args.read_id_file_path)
+        target_read_count = len(target_read_id_records)
         print(f'{target_read_count} unique reads are found in \'{args.read_id_file_path}\'')
 
+        read_stats = get_read_id_records_stats(target_read_id_records)
+
         if target_read_count == 0 and not args.dry_run:
             sys.exit(f'Target read Id file \'{args.read_id_file_path}\' is empty.')
 
@@ -288,32 +1458,38 @@ def main():
         sys.exit('No BAM file or target read Id file is provided.')
 
     if args.dry_run:
+        print('Read stats:')
+        print(json.dumps(read_stats.to_dict(), indent=2))
         print('No action performed in dry-run mode.')
         sys.exit(0)
 
     if subsample_val == 1:
-        output_read_ids = target_read_ids
+        output_read_id_records = target_read_id_records
         final_target_read_file_path = target_reads_file_path
     else:
-        output_read_ids = subsample_reads(target_read_ids, subsample_val, args.seed)
-        subsample_size = len(output_read_ids)
+        if is_hash_subsample:
+            output_read_id_records = hash_subsample_read_id_records(target_read_id_records, subsample_val, args.seed)
+            print(f'Subsampling {len(output_read_id_records)} reads by read Id hash (seed: {args.seed})')
+        else:
+            output_read_id_records = subsample_reads(target_read_id_records, subsample_val, args.seed)
+
+        subsample_size = len(output_read_id_records)
         output_reads_file_name_prefix = f'{output_reads_file_name_prefix}.subsample_{subsample_size}'
-        #final_target_read_file_path = generate_target_reads_file(output_read_ids, output_dir_path, output_reads_file_name_prefix)
-        final_target_read_file_path = generate_target_reads_file(output_read_ids, args.output_dir_path, output_reads_file_name_prefix)
+        #final_target_read_file_path = generate_target_reads_file(output_read_id_records, output_dir_path, output_reads_file_name_prefix)
+        final_target_read_file_path = generate_target_reads_file(output_read_id_records, args.output_dir_path, output_reads_file_name_prefix)
+
+        # Length stats describe the exported subsample, while drop counts still come from the full scan. A BAM scan
+        # already streams the stats of a hash subsample.
+        if args.bam_file_path is None or not is_hash_subsample:
+            read_stats = get_read_id_records_stats(output_read_id_records, read_stats.read_drop_counts)
+
+    read_stats_file_path = generate_read_stats_file(read_stats, args.output_dir_path, output_reads_file_name_prefix)
 
     print('Exporting reads...')
 
-    if is_fast5_exist:
-        #extract_target_reads_from_fast5_dir(args.src_read_dir_paths, output_dir_path, final_target_read_file_path,
-        #                                    output_reads_file_name_prefix, proc_threads)
-        extract_target_reads_from_fast5_dir(args.src_read_dir_paths, args.output_dir_path, final_target_read_file_path,
-                                            output_reads_file_name_prefix, proc_threads)
-    
-    if is_pod5_exist:
-        #extract_target_reads_from_pod5_dir(args.src_read_dir_paths, output_dir_path, final_target_read_file_path,
-        #                                   output_reads_file_name_prefix, proc_threads)
-        extract_target_reads_from_pod5_dir(args.src_read_dir_paths, args.output_dir_path, final_target_read_file_path,
-                                           output_reads_file_name_prefix, proc_threads)
+    read_file_exts = [e for e, is_exist in [(FAST5_FILE_EXT, is_fast5_exist), (POD5_FILE_EXT, is_pod5_exist)] if is_exist]
+    extract_target_reads_from_read_files(read_file_exts, read_file_manifest, args.output_dir_path, [output_read_id_records],
+                                         [output_reads_file_name_prefix], proc_threads, read_file_index)
 
     #print(f'Extracted reads exported to directory \'{output_dir_path}\'')
     print(f'Extracted reads exported to directory \'{args.output_dir_path}\'')
@@ -321,5 +1497,7 @@ def main():
     if args.bam_file_path is not None and not args.dry_run and final_target_read_file_path is not None:
         print(f'The read Id list is exported to {final_target_read_file_path}')
 
+    print(f'The read stats are exported to {read_stats_file_path}')
+
 if __name__ == '__main__':
     main()
@@ -393,6 +393,19 @@ call_short_variants = {
             gvcfFlags = "--gvcf" 
         }
 
+        def gqBandsOpt = calling.gvcf_gq_bands ? "--gq_bands $calling.gvcf_gq_bands" : ""
+
+        def fillNonRefAfOpt = calling.gvcf_fill_non_ref_af ? "--fill_non_ref_af" : ""
+
+        // Only the listed contigs are decoded and fixed, the rest are passed through as compressed blocks
+        def fixContigsOpt = ""
+        if(calling.gvcf_fix_contigs == "all") {
+            fixContigsOpt = "--all_contigs"
+        }
+        else if(calling.gvcf_fix_contigs) {
+            fixContigsOpt = "--contigs ${calling.gvcf_fix_contigs.split(',').join(' ')} --passthrough"
+        }
+
         exec """
             set -uo pipefail
 
@@ -414,14 +427,14 @@ call_short_variants = {
 
             $BASE/scripts/fix_clair3_gvcf_v2.py
                 -i ${output.dir}/merge_output.gvcf.gz
-                -o $output.g.vcf.gz.prefix
+                -o $output.g.vcf.gz
                 -r $REF
+                -t $threads
+                $gqBandsOpt
+                $fillNonRefAfOpt
+                $fixContigsOpt
 
-            bgzip -c $output.g.vcf.gz.prefix > $output.g.vcf.gz
-
-            tabix -p vcf $output.g.vcf.gz
-
-            rm ${output.dir}/merge_output.gvcf.gz* $output.g.vcf.gz.prefix
+            rm ${output.dir}/merge_output.gvcf.gz*
         """
     }
 }
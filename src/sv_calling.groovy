@@ -277,14 +277,9 @@ cutesv = {
                 $cutesv_tmp_dir
 
             bcftools view ${branch.dir}/${sample}.cutesv.tmp.vcf |
-                awk -f $BASE/scripts/count_sv_support.awk |
-                awk -f $BASE/scripts/fix_allele_seq.awk > ${branch.dir}/${sample}.cutesv.tmp2.vcf
+                awk -f $BASE/scripts/fix_allele_seq.awk > $output.vcf
 
-            echo '##INFO=<ID=SUPPORT,Number=1,Type=Integer,Description="Number of reads supporting the structural variation">' > ${branch.dir}/vcf_header.txt
-
-            bcftools annotate -h ${branch.dir}/vcf_header.txt -o $output.vcf ${branch.dir}/${sample}.cutesv.tmp2.vcf
-
-            rm ${branch.dir}/${sample}.cutesv.tmp*.vcf ${branch.dir}/vcf_header.txt
+            rm ${branch.dir}/${sample}.cutesv.tmp.vcf
 
             rm -rf $cutesv_tmp_dir
         """
@@ -304,6 +299,7 @@ filter_sv_calls = {
 
     def in_file = ''
     def out_files = []
+    def support_opt = ''
     
     if (sv_tool == 'sniffles') {
         in_file = "${sample}.sniffles.vcf"
@@ -314,25 +310,38 @@ filter_sv_calls = {
         out_files = ["${sample}.${sv_tool}.vcf.gz", "${sample}_${sv_tool}_filter.sh"]
     }
 
+    // cuteSV reports supporting reads only as RNAMES, so SUPPORT is counted from them while filtering
+    if (sv_tool == 'cutesv') {
+        support_opt = '--support_from_rnames'
+    }
+
     from(in_file) produce(out_files) {
+
+        // The caller VCF is sorted, bgzipped and indexed first, so that contigs are filtered in parallel
+        def sorted_vcf = "${input.vcf.prefix}.sorted.tmp.vcf.gz"
+
         exec """
             set -o pipefail
 
+            $BASE/scripts/vcfsort -T $TMPDIR -N $threads $input.vcf | bgzip -@ $threads -c > $sorted_vcf
+
+            tabix -p vcf $sorted_vcf
+
             $BASE/scripts/get_filter_calls_command.py 
                 --target_bedfile $opts.targets
-                --vcf $input.vcf
+                --vcf $sorted_vcf
                 --depth_bedfile $input.bed.gz
                 --min_sv_length $calling.min_sv_length
                 --max_sv_length $calling.max_sv_length
                 --sv_types ${calling.sv_types.split(',').join(' ')}
                 --min_read_support $calling.min_read_support
-                --min_read_support_limit $calling.min_read_support_limit > $output.sh
-
-            bash $output.sh > $output.vcf.gz.prefix
+                --min_read_support_limit $calling.min_read_support_limit
+                --output $output.vcf.gz
+                --output_vcf $output.vcf.gz.prefix
+                $support_opt
+                --threads $threads > $output.sh
 
-            $BASE/scripts/vcfsort -T $TMPDIR -N $threads $output.vcf.gz.prefix | bgzip -c > $output.vcf.gz
-
-            tabix -p vcf $output.vcf.gz
+            rm $sorted_vcf ${sorted_vcf}.tbi
         """
         
         sample_sv_vcfs.get("${sv_tool}#${sample}", []).add(output.vcf.gz.prefix.toString())
@@ -532,6 +541,8 @@ prepare_sv_alignment_plots = {
             set -uo pipefail
 
             python $tools.LRS_PLOTTING_HOME/prepare-alignments.py
+                --threads $threads
+                --sweep
                 $input.bam
                 $input.vcf.gz
                 $output.zip
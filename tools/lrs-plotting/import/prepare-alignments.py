@@ -8,15 +8,25 @@ Options:
     -L                      Take one or more loci from the command line and write to stdout.
     --split-indels          Split alignments at insertions/deletions
     --min-indel N           Threshold for splitting indels [default: 50].
+    --threads N             Number of worker processes scanning SV records [default: 1].
+    --sweep                 Merge nearby SV windows and fetch each merged region once.
 """
 
 import re
 import sys
 import json
+import bisect
 import docopt
 import pysam
 import zipfile
 import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+# SV records handed to a worker at a time
+SV_BATCH_SIZE = 256
+# SV windows closer than this are fetched as one region, up to a max. region length
+REGION_MERGE_GAP = 1000
+REGION_MAX_LENGTH = 1000000
 
 def parse_locus(locus):
     m = re.match("([^:]+):([0-9,]+)-([0-9,]+)$", locus)
@@ -320,17 +330,191 @@ def mainFromLoci(args):
         out[f'{chrom}:{start}-{stop}'] = items
     json.dump(out, sys.stdout, indent=2)
 
+def get_sv_intervals(start, stop, border):
+    if start + border >= stop - border:
+        return [(max(1, start - border), stop + border)]
+    return [(max(1, start - border), start + border), (max(1, stop  - border), stop + border)]
+
+def scan_sv_items(bam, chrom, start, stop, border, BIG):
+    items = set()
+    seen = set()
+    for (ivlStart, ivlEnd) in get_sv_intervals(start, stop, border):
+        for item in scan_reads_simple(bam, chrom, ivlStart, ivlEnd, seen):
+            (nm, segs) = item
+            for seg in sorted(segs):
+                (segChrom, pos, strand, cig, qual) = seg
+                for (p, off, subCig, rlen, qlen, r) in split_cigar(cig, None, strand):
+                    items.add((nm, segChrom, pos + p, strand, qual, off, rlen, qlen))
+            if len(items) > BIG:
+                break
+    return items
+
+def scan_sa_alignments(bam, chrom, start, end):
+    """Parse the alignments with supplementary alignments in a region once, as (start, end, segments) in fetch order."""
+    alns = []
+    for a in bam.fetch(chrom, start, end):
+        flg = a.flag
+        if flg & 4 == 4: # unmapped
+            continue
+        if flg & 256 == 256: # secondary
+            continue
+        if not a.has_tag("SA"):
+            continue
+
+        qname = a.query_name
+        strand = "+"
+        if flg & 16 > 0:
+            strand = "-"
+        segs = [(qname, a.reference_name, a.reference_start + 1, strand, a.cigarstring, a.mapping_quality)]
+
+        for sa in a.get_tag("SA").split(";"):
+            if sa == "":
+                continue
+            parts = sa.split(",")
+            segs.append((qname, parts[0], int(parts[1]), parts[2], parts[3], int(parts[4])))
+
+        # As in htslib, alignments without reference length span one base
+        aend = a.reference_end
+        if aend is None:
+            aend = a.reference_start + 1
+        alns.append((a.reference_start, aend, segs))
+    return alns
+
+def get_seg_items(seg, segItems):
+    if seg not in segItems:
+        (nm, chrom, pos, strand, cig, qual) = seg
+        segItems[seg] = [(nm, chrom, pos + p, strand, qual, off, rlen, qlen)
+                         for (p, off, subCig, rlen, qlen, r) in split_cigar(cig, None, strand)]
+    return segItems[seg]
+
+def sweep_sv_window_items(region, ivlStart, ivlEnd, seen, items, BIG, segItems):
+    """Add the items of a window from a scanned region, as scan_reads_simple() over the window would."""
+    (alns, starts, maxSpan) = region
+    lo = bisect.bisect_left(starts, ivlStart - maxSpan)
+    hi = bisect.bisect_left(starts, ivlEnd)
+    for (astart, aend, segs) in alns[lo:hi]:
+        if aend <= ivlStart:
+            continue
+
+        slug = segs[0][:3]
+        if slug in seen:
+            continue
+        seen.add(slug)
+
+        newSegs = [segs[0]]
+        for seg in segs[1:]:
+            slug = seg[:3]
+            if slug in seen:
+                continue
+            seen.add(slug)
+            newSegs.append(seg)
+
+        for seg in newSegs:
+            items.update(get_seg_items(seg, segItems))
+        if len(items) > BIG:
+            break
+
+def merge_sv_windows(windows):
+    """Merge windows into fetch regions, returning the regions and the region of each window."""
+    regions = []
+    windowRegions = [None] * len(windows)
+    for k in sorted(range(len(windows)), key=lambda k: windows[k]):
+        (s, e) = windows[k]
+        if len(regions) > 0 and s - regions[-1][1] <= REGION_MERGE_GAP and e - regions[-1][0] <= REGION_MAX_LENGTH:
+            regions[-1][1] = max(regions[-1][1], e)
+        else:
+            regions.append([s, e])
+        windowRegions[k] = len(regions) - 1
+    return (regions, windowRegions)
+
+def sweep_contig_sv_entries(bam, chrom, loci, border, BIG):
+    """Scan the SVs of a contig, fetching each region of merged SV windows once."""
+    svWindows = [get_sv_intervals(start, stop, border) for (start, stop) in loci]
+    windows = [w for ws in svWindows for w in ws]
+    (regions, windowRegions) = merge_sv_windows(windows)
+
+    scanned = []
+    for (s, e) in regions:
+        alns = scan_sa_alignments(bam, chrom, s, e)
+        maxSpan = max([aend - astart for (astart, aend, segs) in alns], default=0)
+        scanned.append((alns, [astart for (astart, aend, segs) in alns], maxSpan))
+
+    segItems = {}
+    entries = []
+    k = 0
+    for ws in svWindows:
+        seen = set()
+        items = set()
+        for (ivlStart, ivlEnd) in ws:
+            sweep_sv_window_items(scanned[windowRegions[k]], ivlStart, ivlEnd, seen, items, BIG, segItems)
+            k += 1
+        if len(items) == 0 or len(items) > BIG:
+            entries.append((len(items), None))
+        else:
+            entries.append((len(items), format_sv_items(items)))
+    return entries
+
+def format_sv_items(items):
+    items = list(sorted(items))
+    for i in range(len(items)):
+        (nm, chrom, pos, strand, qual, off, rlen, qlen) = items[i]
+        items[i] = {"readid": nm, "chrom": chrom, "pos": pos, "strand": strand, "qual": qual, "offset": off, "rlen": rlen, "qlen": qlen}
+    return json.dumps(items)
+
+def scan_sv_entry(bam, chrom, start, stop, border, BIG):
+    """Get the no. of items for an SV and their JSON, or None if there are none or too many to write."""
+    items = scan_sv_items(bam, chrom, start, stop, border, BIG)
+    if len(items) == 0 or len(items) > BIG:
+        return (len(items), None)
+    return (len(items), format_sv_items(items))
+
+def init_sv_worker(bamName):
+    global worker_bam
+    worker_bam = pysam.AlignmentFile(bamName, "rb")
+
+def scan_sv_batch(loci, border, BIG):
+    return [scan_sv_entry(worker_bam, chrom, start, stop, border, BIG) for (chrom, start, stop) in loci]
+
+def sweep_contig_sv_batch(chrom, loci, border, BIG):
+    return sweep_contig_sv_entries(worker_bam, chrom, loci, border, BIG)
+
+def sweep_sv_entries(bamName, loci, border, BIG, threads):
+    """Scan SVs contig by contig from merged windows, getting their entries in the original order."""
+    contigIndices = {}
+    for (i, (chrom, start, stop)) in enumerate(loci):
+        contigIndices.setdefault(chrom, []).append(i)
+    contigs = list(contigIndices)
+    contigLoci = [[loci[i][1:] for i in contigIndices[chrom]] for chrom in contigs]
+
+    if threads > 1:
+        with ProcessPoolExecutor(max_workers=threads, initializer=init_sv_worker, initargs=(bamName,)) as executor:
+            contigEntries = list(executor.map(sweep_contig_sv_batch, contigs, contigLoci,
+                                              [border] * len(contigs), [BIG] * len(contigs)))
+    else:
+        bam = pysam.AlignmentFile(bamName, "rb")
+        contigEntries = [sweep_contig_sv_entries(bam, chrom, cl, border, BIG) for (chrom, cl) in zip(contigs, contigLoci)]
+
+    entries = [None] * len(loci)
+    for (chrom, es) in zip(contigs, contigEntries):
+        for (i, entry) in zip(contigIndices[chrom], es):
+            entries[i] = entry
+    return entries
+
+def batched(xs, n):
+    for i in range(0, len(xs), n):
+        yield xs[i:i + n]
+
 def mainShallow(args):
     bamName = args["<bam>"]
     vcfName = args["<sv-vcf>"]
     zipName = args["<zip-name>"]
+    threads = int(args["--threads"])
 
     BIG = 1000
     border = 50
 
-    nn = 0
-    out = zipfile.ZipFile(zipName, mode="w", compression=zipfile.ZIP_DEFLATED)
-    bam = pysam.AlignmentFile(bamName, "rb")
+    keys = []
+    loci = []
     for rec in pysam.VariantFile(vcfName):
         chrom = rec.chrom
         start = rec.pos
@@ -340,43 +524,43 @@ def mainShallow(args):
         if "SVLEN" in rec.info:
             svlen = rec.info["SVLEN"]
         h = sig(rec.alleles, svlen)
-        key = f'{chrom}:{start}-{stop}-{kind}-{h}.json'
+        keys.append(f'{chrom}:{start}-{stop}-{kind}-{h}.json')
+        loci.append((chrom, start, stop))
+
+    # Workers each scan batches of SVs with their own BAM handle, and
+    # the entries are written here in VCF order, as in a serial scan.
+    if args["--sweep"]:
+        entries = sweep_sv_entries(bamName, loci, border, BIG, threads)
+        write_sv_entries(zipName, keys, entries, BIG)
+    elif threads > 1:
+        with ProcessPoolExecutor(max_workers=threads, initializer=init_sv_worker, initargs=(bamName,)) as executor:
+            batches = executor.map(scan_sv_batch, batched(loci, SV_BATCH_SIZE), [border] * len(loci), [BIG] * len(loci))
+            entries = (entry for batch in batches for entry in batch)
+            write_sv_entries(zipName, keys, entries, BIG)
+    else:
+        bam = pysam.AlignmentFile(bamName, "rb")
+        entries = (scan_sv_entry(bam, chrom, start, stop, border, BIG) for (chrom, start, stop) in loci)
+        write_sv_entries(zipName, keys, entries, BIG)
 
+def write_sv_entries(zipName, keys, entries, BIG):
+    nn = 0
+    out = zipfile.ZipFile(zipName, mode="w", compression=zipfile.ZIP_DEFLATED)
+    for (key, (n, text)) in zip(keys, entries):
         nn += 1
         if nn & 255 == 0:
             print(key)
 
-        seen = set()
-        items = set()
-        if start + border >= stop - border:
-            intervals = [(max(1, start - border), stop + border)]
-        else:
-            intervals = [(max(1, start - border), start + border), (max(1, stop  - border), stop + border)]
-        for (ivlStart, ivlEnd) in intervals:
-            for item in scan_reads_simple(bam, chrom, ivlStart, ivlEnd, seen):
-                (nm, segs) = item
-                for seg in sorted(segs):
-                    (chrom, pos, strand, cig, qual) = seg
-                    for (p, off, subCig, rlen, qlen, r) in split_cigar(cig, None, strand):
-                        items.add((nm, chrom, pos + p, strand, qual, off, rlen, qlen))
-                if len(items) > BIG:
-                    break
-
-        if len(items) == 0:
+        if n == 0:
             # no supplementary mappings!
             # This is a todo case where
             # we might want to split
             # the CIGAR mappings.
             continue
 
-        if len(items) > BIG:
+        if n > BIG:
             print(f'dropping {key}')
             continue
-        items = list(sorted(items))
-        for i in range(len(items)):
-            (nm, chrom, pos, strand, qual, off, rlen, qlen) = items[i]
-            items[i] = {"readid": nm, "chrom": chrom, "pos": pos, "strand": strand, "qual": qual, "offset": off, "rlen": rlen, "qlen": qlen}
-        out.writestr(key, json.dumps(items))
+        out.writestr(key, text)
     out.close()
 
 def mainDeep(args):